@@ -6,6 +6,7 @@
 
 import os, subprocess, sys, shutil
 from midas import utility
+from midas.run import marker_index, index_cache, genes, build_fasta
 import Bio.SeqIO
 
 class Species:
@@ -163,6 +164,8 @@ def build_marker_db(args, genomes, species):
 	utility.check_exit_code(process, command)
 	print("4. Copying mapping cutoffs file")
 	build_mapping_cutoffs(args)
+	print("5. Compiling marker index")
+	marker_index.build_index(args['outdir'])
 
 def build_mapping_cutoffs(args):
 	cutoffs = {
@@ -205,6 +208,7 @@ def build_pangenome_db(args, species):
 		pangenome.translate()
 		pangenome.record_info()
 		pangenome.clean_up()
+		genes.write_gene_ids(args['outdir'], sp.id)
 
 class Gene:
 	def __init__(self, id):
@@ -361,6 +365,29 @@ class Pangenome:
 		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 		utility.check_exit_code(process, command)
 
+def build_bowtie2_db(args, species):
+	""" Build bowtie2 databases of all pangenome centroids and all representative genomes
+		Used by 'run_midas.py genes/snps --prebuilt' in place of per-sample databases """
+	outdir = index_cache.prebuilt_dir(args['outdir'])
+	if not os.path.isdir(outdir): os.makedirs(outdir)
+	for prefix, module, file in [('pangenomes', 'pan_genomes', 'centroids.ffn'), ('genomes', 'rep_genomes', 'genome.fna')]:
+		print("%s: writing FASTA" % prefix)
+		sources = []
+		for sp in species:
+			for ext in ['', '.gz']:
+				inpath = '%s/%s/%s/%s%s' % (args['outdir'], module, sp.id, file, ext)
+				if os.path.isfile(inpath): break
+			sources.append((sp.id, inpath))
+		build_fasta.build_fasta(sources, outdir, prefix, args['threads'])
+		print("%s: building bowtie2 index" % prefix)
+		command = '%s %s/%s.fa %s/%s' % (args['bowtie2-build'], outdir, prefix, outdir, prefix)
+		process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		utility.check_exit_code(process, command)
+	# index of genomes.fa for samtools mpileup; the database may be read-only when used
+	command = '%s faidx %s/genomes.fa' % (args['samtools'], outdir)
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	utility.check_exit_code(process, command)
+
 def write_species_info(args, species):
 	outfile = utility.iopen('%s/species_info.txt' % args['outdir'], 'w')
 	header = ['species_id', 'rep_genome', 'count_genomes']
@@ -406,6 +433,12 @@ def run_pipeline(args):
 		print("Compressing data\n")
 		compress(args['outdir'])
 
+	if args['bowtie2_index']:
+		print("Building bowtie2 databases of all species")
+		print("=====================")
+		build_bowtie2_db(args, species)
+		print("")
+
 
 
 
@@ -8,6 +8,7 @@ import argparse, sys, os, gzip
 from collections import defaultdict
 from midas import utility
 from midas.merge import merge
+from midas.run import genes
 
 def build_gene_matrices(species_id, samples, args):
 	""" Compute gene copy numbers for samples """
@@ -15,6 +16,10 @@ def build_gene_matrices(species_id, samples, args):
 		sample.genes = {}
 		for type in ['presabs', 'copynum', 'depth']:
 			sample.genes[type] = defaultdict(float)
+		inpath = '%s/genes/output/%s.genes.npz' % (sample.dir, species_id)
+		if os.path.isfile(inpath): # sparse output of run_midas.py genes --sparse
+			read_sparse_genes(sample, inpath, genes.read_gene_ids(args['db'], species_id))
+			continue
 		inpath = '%s/genes/output/%s.genes.gz' % (sample.dir, species_id)
 		for r in utility.parse_file(inpath):
 			if 'ref_id' in r: r['gene_id'] = r['ref_id'] # fix old fields if present
@@ -28,6 +33,15 @@ def build_gene_matrices(species_id, samples, args):
 			if copynum >= args['min_copy']: sample.genes['presabs'][gene_id] = 1
 			else: sample.genes['presabs'][gene_id] = 0
 
+def read_sparse_genes(sample, inpath, gene_ids):
+	""" Fill in depth and copy number of all genes from sparse output """
+	sparse = genes.read_sparse(inpath)
+	if int(sparse['pangenome_size']) != len(gene_ids):
+		sys.exit("\nError: %s has %s genes, but the database lists %s" % (inpath, int(sparse['pangenome_size']), len(gene_ids)))
+	for type, field in [('depth', 'coverage'), ('copynum', 'copy_number')]:
+		sample.genes[type].update(dict.fromkeys(gene_ids, 0.0))
+		sample.genes[type].update(zip([gene_ids[_] for _ in sparse['index']], sparse[field].astype(float).tolist()))
+
 def write_gene_matrices(species_id, samples, args):
 	""" Compute pangenome matrices to file """
 	# open outfiles
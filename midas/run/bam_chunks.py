@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+# Split an unsorted, unindexed BAM into chunks of records that can be read in parallel
+# Chunks start at BGZF blocks; the first record in a block is found by checking that a chain of
+# consecutive records parses as valid BAM records, so no pass over the whole file is needed
+
+import struct, zlib
+
+max_record = 2**24 # larger records are assumed to be invalid
+sync_records = 8 # consecutive records that must be valid to accept a record start
+
+def bgzf_blocks(inpath):
+	""" Return compressed offset of each BGZF block from block headers """
+	offsets = []
+	with open(inpath, 'rb') as infile:
+		offset = 0
+		while True:
+			infile.seek(offset)
+			header = infile.read(18)
+			if len(header) < 18: break
+			if header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+				raise ValueError("Invalid BGZF block at offset %s of %s" % (offset, inpath))
+			offsets.append(offset)
+			offset += struct.unpack('<H', header[16:18])[0] + 1
+	return offsets
+
+def read_blocks(inpath, start, stop):
+	""" Decompress BGZF blocks between compressed offsets start and stop """
+	with open(inpath, 'rb') as infile:
+		infile.seek(start)
+		data = infile.read(stop - start)
+	blocks = []
+	offset = 0
+	while offset < len(data):
+		size = struct.unpack('<H', data[offset+16:offset+18])[0] + 1
+		blocks.append(zlib.decompress(data[offset+18:offset+size-8], -15))
+		offset += size
+	return b''.join(blocks)
+
+def is_record(data, offset, n_refs):
+	""" Check if a valid BAM record starts at offset; returns offset of next record, or None """
+	if offset + 36 > len(data):
+		return None
+	block_size, ref_id, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_ref_id, next_pos = struct.unpack_from('<iiiBBHHHiii', data, offset)
+	if block_size < 32 or block_size > max_record:
+		return None
+	if not (-1 <= ref_id < n_refs and -1 <= next_ref_id < n_refs and pos >= -1 and next_pos >= -1):
+		return None
+	if l_read_name < 2 or l_seq < 0:
+		return None
+	if 32 + l_read_name + 4 * n_cigar_op + (l_seq + 1)//2 + l_seq > block_size:
+		return None
+	name_start = offset + 36
+	name = data[name_start:name_start + l_read_name]
+	if len(name) < l_read_name or name[-1:] != b'\x00' or b'\x00' in name[:-1]:
+		return None
+	if any([c < 33 or c > 126 for c in bytearray(name[:-1])]):
+		return None
+	return offset + 4 + block_size
+
+def find_record(data, size, n_refs, at_eof=False):
+	""" Find first offset < size in data where a chain of sync_records valid records starts, or None
+		Returns -1 if a chain reaches the end of data before it is verified, so more data must be read
+		If data ends at the end of file (at_eof), a shorter chain that ends exactly there is accepted """
+	for offset in range(size):
+		next, count = offset, 0
+		while count < sync_records:
+			if at_eof and next == len(data):
+				break
+			if not at_eof and len(data) - next < 36 + 255: # record may be cut off by end of data
+				return -1
+			next = is_record(data, next, n_refs)
+			if next is None: break
+			count += 1
+		if next is not None:
+			return offset
+	return None
+
+def split_bam(inpath, header_end, n_refs, chunks):
+	""" Split records of bam into chunks of similar compressed size
+		header_end is virtual offset of the first record; returns list of (start, stop) virtual offsets, stop=None at end of file """
+	blocks = bgzf_blocks(inpath)
+	first = header_end >> 16
+	blocks = [_ for _ in blocks if _ >= first]
+	if len(blocks) < 2 or chunks < 2:
+		return [(header_end, None)]
+	starts = [header_end]
+	file_end = blocks[-1] # last block is empty EOF marker
+	for i in range(1, chunks):
+		target = first + (file_end - first) * i // chunks
+		index = next(j for j, offset in enumerate(blocks) if offset >= target)
+		while index < len(blocks) - 1:
+			# decompress a few blocks so record chains can cross block boundaries
+			block_size = len(read_blocks(inpath, blocks[index], blocks[index + 1]))
+			end = min(index + 4, len(blocks) - 1)
+			while True:
+				data = read_blocks(inpath, blocks[index], blocks[end])
+				offset = find_record(data, block_size, n_refs, end == len(blocks) - 1)
+				if offset != -1: break
+				end = min(index + 2 * (end - index), len(blocks) - 1) # chain not verified: read more blocks
+			if offset is not None: break
+			index += 1 # no record starts in block
+		if index == len(blocks) - 1: break
+		voffset = (blocks[index] << 16) | offset
+		if voffset > starts[-1]: starts.append(voffset)
+	return list(zip(starts, starts[1:] + [None]))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+# Concatenate FASTA files of species into a single FASTA and map of sequence ids to species ids
+# Files are read as blocks of raw bytes holding whole records; sequences are written on one line in upper case
+
+import os, shutil, tempfile
+from midas import utility
+
+block_size = 2**24 # bytes read at a time
+whitespace = b' \t\r\n' # removed from sequences
+
+def read_blocks(inpath):
+	""" Yield blocks of bytes from FASTA file, each starting at a header line and holding whole records
+		Any text before the first header is skipped """
+	infile = utility.bopen(inpath)
+	rest = b''
+	while True:
+		data = infile.read(block_size)
+		if not data: break
+		data = rest + data
+		if data[:1] != b'>': # text before first record
+			start = data.find(b'\n>')
+			if start == -1:
+				rest = data[-1:]
+				continue
+			data = data[start+1:]
+		end = data.rfind(b'\n>')
+		if end == -1:
+			rest = data
+		else:
+			yield data[:end+1]
+			rest = data[end+1:]
+	infile.close()
+	if rest[:1] == b'>': yield rest
+
+def format_block(block, species_id):
+	""" Return FASTA, map, number of sequences, and total length of records in block """
+	seqs, ids = [], []
+	length = 0
+	for record in block[1:].split(b'\n>'):
+		header, _, seq = record.partition(b'\n')
+		header = header.split(None, 1)
+		id = header[0] if header else b''
+		seq = seq.translate(None, whitespace).upper()
+		seqs += [b'>', id, b'\n', seq, b'\n']
+		ids += [id, b'\t', species_id, b'\n']
+		length += len(seq)
+	return b''.join(seqs), b''.join(ids), len(seqs)//5, length
+
+def write_species(species_id, inpath, seqfile, mapfile):
+	""" Append records of species to open FASTA and map files; returns number of sequences and total length """
+	stats = [0, 0]
+	for block in read_blocks(inpath):
+		seqs, ids, count, length = format_block(block, species_id.encode())
+		seqfile.write(seqs)
+		mapfile.write(ids)
+		stats[0] += count
+		stats[1] += length
+	return stats
+
+def write_part(species_id, inpath, outpath):
+	""" Write records of species to <outpath>.fa and <outpath>.map """
+	with open(outpath+'.fa', 'wb') as seqfile, open(outpath+'.map', 'wb') as mapfile:
+		return write_species(species_id, inpath, seqfile, mapfile)
+
+def build_fasta(sources, outdir, prefix, threads=1):
+	""" Write <outdir>/<prefix>.fa and <outdir>/<prefix>.map from list of (species_id, fasta) in order
+		With multiple threads, species are written to temporary files by a pool of processes and then concatenated
+		Returns dict of number of species, sequences, and total length """
+	stats = {'species':len(sources), 'total_seqs':0, 'total_length':0}
+	seqfile = open('%s/%s.fa' % (outdir, prefix), 'wb')
+	mapfile = open('%s/%s.map' % (outdir, prefix), 'wb')
+	if int(threads) > 1 and len(sources) > 1:
+		from multiprocessing import Pool
+		tempdir = tempfile.mkdtemp(dir=outdir, prefix='.%s.' % prefix)
+		pool = Pool(int(threads))
+		results = [pool.apply_async(write_part, (species_id, inpath, '%s/%s' % (tempdir, index)))
+				   for index, (species_id, inpath) in enumerate(sources)]
+		for index, result in enumerate(results): # in order of sources
+			counts = result.get()
+			for ext, outfile in [('fa', seqfile), ('map', mapfile)]:
+				with open('%s/%s.%s' % (tempdir, index, ext), 'rb') as infile:
+					shutil.copyfileobj(infile, outfile)
+				os.remove('%s/%s.%s' % (tempdir, index, ext))
+			stats['total_seqs'] += counts[0]
+			stats['total_length'] += counts[1]
+		pool.close()
+		pool.join()
+		shutil.rmtree(tempdir)
+	else:
+		for species_id, inpath in sources:
+			counts = write_species(species_id, inpath, seqfile, mapfile)
+			stats['total_seqs'] += counts[0]
+			stats['total_length'] += counts[1]
+	seqfile.close()
+	mapfile.close()
+	return stats
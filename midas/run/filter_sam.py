@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import sys
+
+def read_refs(mappath):
+	""" Read set of reference ids from first column of genomes.map or pangenomes.map """
+	return set([line.split('\t', 1)[0] for line in open(mappath)])
+
+def filter_sam(lines, refs):
+	""" Yield SAM lines with @SQ headers and alignments restricted to reference ids in refs
+		Mates aligned to other references are marked as unplaced so the output is valid SAM """
+	for line in lines:
+		if line[0] == '@':
+			if not line.startswith('@SQ\t') or line.split('\t', 2)[1][3:].rstrip('\n') in refs:
+				yield line
+			continue
+		values = line.split('\t', 9)
+		if values[2] not in refs:
+			continue
+		if values[6] not in ('=', '*') and values[6] not in refs:
+			values[6], values[7] = '*', '0'
+			line = '\t'.join(values)
+		yield line
+
+if __name__ == '__main__':
+
+	if len(sys.argv) != 2:
+		sys.exit("Usage: filter_sam.py MAPFILE < in.sam > out.sam")
+	for line in filter_sam(sys.stdin, read_refs(sys.argv[1])):
+		sys.stdout.write(line)
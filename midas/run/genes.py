@@ -4,30 +4,18 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, os, subprocess, gzip
+import sys, os, subprocess, gzip, re, itertools
 from time import time
 from midas import utility
-from midas.run import stream_bam
+from midas.run import index_cache, filter_sam, bam_chunks, build_fasta
 
 def build_pangenome_db(args, species):
 	""" Build FASTA and BT2 database from pangene species centroids """
-	import Bio.SeqIO
 	# fasta database
 	outdir = '/'.join([args['outdir'], 'genes/temp'])
-	pangenome_fasta = open('/'.join([outdir, 'pangenomes.fa']), 'w')
-	pangenome_map = open('/'.join([outdir, 'pangenomes.map']), 'w')
-	db_stats = {'total_length':0, 'total_seqs':0, 'species':0}
-	for sp in species.values():
-		db_stats['species'] += 1
-		infile = utility.iopen(sp.pan_genome)
-		for r in Bio.SeqIO.parse(infile, 'fasta'):
-			pangenome_fasta.write('>%s\n%s\n' % (r.id, str(r.seq).upper()))
-			pangenome_map.write('%s\t%s\n' % (r.id, sp.id))
-			db_stats['total_length'] += len(r.seq)
-			db_stats['total_seqs'] += 1
-		infile.close()
-	pangenome_fasta.close()
-	pangenome_map.close()
+	index_cache.remove_database(outdir, 'pangenomes')
+	sources = [(sp.id, sp.pan_genome) for sp in species.values()]
+	db_stats = build_fasta.build_fasta(sources, outdir, 'pangenomes', args['threads'])
 	# print out database stats
 	print("  total species: %s" % db_stats['species'])
 	print("  total genes: %s" % db_stats['total_seqs'])
@@ -58,10 +46,16 @@ def pangenome_align(args):
 	if args['file_type'] == 'fasta': command += '-f '
 	else: command += '-q '
 	#   input file
-	if (args['m1'] and args['m2']): command += '-1 %s -2 %s ' % (args['m1'], args['m2'])
-	else: command += '-U %s ' % args['m1']
+	if utility.prefilter_reads(args): stream, (m1, m2) = utility.stream_filtered_reads(args, 'genes')
+	else: stream, m1, m2 = None, args['m1'], args['m2']
+	if (m1 and m2): command += '-1 %s -2 %s ' % (m1, m2)
+	else: command += '-U %s ' % m1
 	#   output unsorted bam
 	bampath = '/'.join([args['outdir'], 'genes/temp/pangenomes.bam'])
+	if args['cov']: # parse alignments as they are streamed
+		return stream_align(args, command, bampath if args['keep_bam'] else None, stream, [m1, m2])
+	if args['prebuilt']: # keep alignments to selected species
+		command += '| python %s %s ' % (args['filter_sam'], '/'.join([args['outdir'], 'genes/temp/pangenomes.map']))
 	command += '| %s view -b - > %s' % (args['samtools'], bampath)
 	# Run command
 	args['log'].write('command: '+command+'\n')
@@ -69,33 +63,169 @@ def pangenome_align(args):
 	# Check for errors
 	print("  finished aligning")
 	utility.check_exit_code(process, command)
+	if utility.prefilter_reads(args): utility.finish_filtered_reads(args, 'genes', stream, [m1, m2])
 	print("  checking bamfile integrity")
 	utility.check_bamfile(args, bampath)
 
+def stream_align(args, command, bampath, stream, paths):
+	""" Run bowtie2 and count bp mapped to each centroid from its SAM output without re-reading a bamfile
+		Alignments are also written to bampath with samtools if specified; returns GeneCoverage """
+	errpath = '/'.join([args['outdir'], 'genes/temp/bowtie2.err'])
+	command += '2> %s' % errpath
+	args['log'].write('command: '+command+'\n')
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+	lines = process.stdout
+	if args['prebuilt']: # keep alignments to selected species
+		lines = filter_sam.filter_sam(lines, filter_sam.read_refs('/'.join([args['outdir'], 'genes/temp/pangenomes.map'])))
+	if bampath:
+		bam_command = '%s view -b - > %s' % (args['samtools'], bampath)
+		args['log'].write('command: '+bam_command+'\n')
+		bam_process = subprocess.Popen(bam_command, shell=True, stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		gene_cov = count_mapped_bp_sam(args, tee_lines(lines, bam_process.stdin))
+		bam_process.stdin.close()
+	else:
+		gene_cov = count_mapped_bp_sam(args, lines)
+	# Check for errors
+	print("  finished aligning")
+	utility.check_stream_exit_code(process, command, errpath)
+	if utility.prefilter_reads(args): utility.finish_filtered_reads(args, 'genes', stream, paths)
+	if bampath:
+		bam_process.wait()
+		if bam_process.returncode != 0:
+			sys.exit("\nError encountered executing:\n%s\n\nError message:\n%s" % (bam_command, bam_process.stderr.read()))
+	return gene_cov
+
+def tee_lines(lines, outfile):
+	""" Yield lines after writing them to outfile """
+	for line in lines:
+		outfile.write(line)
+		yield line
+
+class GeneCoverage:
+	""" Coverage of each centroid accumulated in arrays indexed by reference_id """
+	def __init__(self, gene_ids, lengths):
+		import numpy as np
+		self.gene_ids = list(gene_ids)
+		self.lengths = np.array(lengths, dtype=float)
+		self.bp = np.zeros(len(self.gene_ids))
+
+	def add_batch(self, args, batch):
+		""" Filter batch of alignments and add aligned bp of those kept to their reference """
+		import numpy as np
+		ref_ids, aligned, lengths, edits, qual_sums, mapqs = [np.array(batch[_]) for _ in batch_fields]
+		if len(ref_ids) == 0: return
+		keep = ((100 * (aligned - edits)/aligned.astype(float) >= args['mapid'])
+			& (aligned/lengths.astype(float) >= args['aln_cov'])
+			& (qual_sums/lengths.astype(float) >= args['readq'])
+			& (mapqs >= args['mapq']))
+		self.bp += np.bincount(ref_ids[keep], weights=aligned[keep], minlength=len(self.bp))
+		for field in batch_fields: batch[field] = []
+
+	def coverage(self):
+		""" Average read-depth of each centroid """
+		return self.bp/self.lengths
+
+batch_fields = ['ref_ids', 'aligned', 'lengths', 'edits', 'qual_sums', 'mapqs']
+
+def count_chunk(filters, bam_path, start, stop, batch_size=100000):
+	""" Count bp mapped to each centroid by alignments between virtual offsets start and stop (None: end of file) of bamfile
+		Returns array of aligned bp indexed by reference_id """
+	import pysam
+	aln_file = pysam.AlignmentFile(bam_path, "rb")
+	gene_cov = GeneCoverage(aln_file.references, aln_file.lengths)
+	aln_file.seek(start)
+	batch = dict([(_, []) for _ in batch_fields])
+	while stop is None or aln_file.tell() < stop:
+		try:
+			aln = next(aln_file)
+		except StopIteration:
+			break
+		if aln.is_unmapped: continue
+		batch['ref_ids'].append(aln.reference_id)
+		batch['aligned'].append(aln.query_alignment_length)
+		batch['lengths'].append(aln.query_length)
+		batch['edits'].append(aln.get_tag('NM'))
+		batch['qual_sums'].append(sum(aln.query_qualities))
+		batch['mapqs'].append(aln.mapping_quality)
+		if len(batch['ref_ids']) == batch_size: gene_cov.add_batch(filters, batch)
+	gene_cov.add_batch(filters, batch)
+	aln_file.close()
+	return gene_cov.bp
+
 def count_mapped_bp(args):
-	""" Count number of bp mapped to each centroid across pangenomes """
-	import pysam, numpy as np
+	""" Count number of bp mapped to each centroid across pangenomes
+		With multiple threads, the bamfile is split into chunks that are counted by a pool of processes """
+	import pysam
 	bam_path = '/'.join([args['outdir'], 'genes/temp/pangenomes.bam'])
 	aln_file = pysam.AlignmentFile(bam_path, "rb")
-	ref_to_length = dict([(i,j) for i,j in zip(aln_file.references, aln_file.lengths)])
-	gene_to_cov = dict([(i,0.0) for i in aln_file.references])
-	for index, aln in enumerate(aln_file.fetch(until_eof = True)):
-		query = aln.query_name
-		if stream_bam.compute_perc_id(aln) < args['mapid']:
-			continue
-		elif stream_bam.compute_aln_cov(aln) < args['aln_cov']:
-			continue
-		elif np.mean(aln.query_qualities) < args['readq']:
-			continue
-		elif aln.mapping_quality < args['mapq']:
-			continue
-		else:
-			gene_id = aln_file.getrname(aln.reference_id)
-			cov = len(aln.query_alignment_sequence)/float(ref_to_length[gene_id])
-			gene_to_cov[gene_id] += cov
-	return gene_to_cov
+	gene_cov = GeneCoverage(aln_file.references, aln_file.lengths)
+	threads = int(args['threads'])
+	chunks = bam_chunks.split_bam(bam_path, aln_file.tell(), aln_file.nreferences, 4 * threads if threads > 1 else 1)
+	aln_file.close()
+	filters = dict([(_, args[_]) for _ in ['mapid', 'aln_cov', 'readq', 'mapq']])
+	if len(chunks) > 1:
+		from multiprocessing import Pool
+		pool = Pool(threads)
+		results = [pool.apply_async(count_chunk, (filters, bam_path, start, stop)) for start, stop in chunks]
+		for result in results: gene_cov.bp += result.get()
+		pool.close()
+		pool.join()
+	else:
+		gene_cov.bp += count_chunk(filters, bam_path, *chunks[0])
+	return gene_cov
+
+cigar_ops = re.compile(r'(\d+)([MIDNSHP=X])')
+
+def parse_cigar(cigar):
+	""" Return number of read bases in alignment and in read, excluding hard-clipped bases """
+	aligned, length = 0, 0
+	for size, op in cigar_ops.findall(cigar):
+		if op in 'MI=X': aligned += int(size)
+		if op in 'MIS=X': length += int(size)
+	return aligned, length
+
+def count_mapped_bp_sam(args, lines, batch_size=100000):
+	""" Count number of bp mapped to each centroid from lines of SAM
+		Reads are filtered as in count_mapped_bp; unaligned mates of aligned reads are skipped """
+	gene_ids, gene_lengths = [], []
+	for line in lines:
+		if line[0] != '@': break
+		if line.startswith('@SQ\t'):
+			tags = dict([_.split(':', 1) for _ in line.rstrip('\n').split('\t')[1:]])
+			gene_ids.append(tags['SN'])
+			gene_lengths.append(int(tags['LN']))
+	else: # no alignments
+		return GeneCoverage(gene_ids, gene_lengths)
+	gene_cov = GeneCoverage(gene_ids, gene_lengths)
+	ref_ids = dict([(j,i) for i,j in enumerate(gene_ids)])
+	batch = dict([(_, []) for _ in batch_fields])
+	for line in itertools.chain([line], lines):
+		values = line.rstrip('\n').split('\t')
+		if int(values[1]) & 4: continue
+		aligned, length = parse_cigar(values[5])
+		batch['ref_ids'].append(ref_ids[values[2]])
+		batch['aligned'].append(aligned)
+		batch['lengths'].append(length)
+		batch['edits'].append([int(_[5:]) for _ in values[11:] if _.startswith('NM:i:')][0])
+		batch['qual_sums'].append(sum(bytearray(values[10].encode())) - 33 * len(values[10]))
+		batch['mapqs'].append(int(values[4]))
+		if len(batch['ref_ids']) == batch_size: gene_cov.add_batch(args, batch)
+	gene_cov.add_batch(args, batch)
+	return gene_cov
+
+def read_gene_species(args, gene_ids):
+	""" Return species_id of each centroid in gene_ids from pangenomes.map """
+	map_genes, map_species = [], []
+	for line in open('/'.join([args['outdir'], 'genes/temp/pangenomes.map'])):
+		gene_id, species_id = line.rstrip().split()
+		map_genes.append(gene_id)
+		map_species.append(species_id)
+	if map_genes == gene_ids: # bowtie2 keeps order of pangenomes.fa
+		return map_species
+	gene_to_species = dict(zip(map_genes, map_species))
+	return [gene_to_species[_] for _ in gene_ids]
 
-def compute_marker_cov(args, species, gene_to_cov, ref_to_species):
+def compute_marker_cov(args, species, gene_cov, gene_species):
 	""" Count number of bp mapped to each marker marker gene """
 	from numpy import median
 	# read in map of gene to marker
@@ -108,11 +238,11 @@ def compute_marker_cov(args, species, gene_to_cov, ref_to_species):
 		for marker_id in marker_ids:
 			species_to_marker_to_cov[species_id][marker_id] = 0.0
 	# compute marker coverages
-	for gene_id, marker_id in gene_to_marker.items():
-		if gene_id in ref_to_species:
-			species_id = ref_to_species[gene_id]
-			if marker_id in marker_ids and gene_id in gene_to_cov:
-				species_to_marker_to_cov[species_id][marker_id] += gene_to_cov[gene_id]
+	coverage = gene_cov.coverage()
+	for index, gene_id in enumerate(gene_cov.gene_ids):
+		if gene_id in gene_to_marker:
+			marker_id = gene_to_marker[gene_id]
+			species_to_marker_to_cov[gene_species[index]][marker_id] += coverage[index]
 	# compute median marker cov
 	species_to_norm = {}
 	for species_id in species_to_marker_to_cov:
@@ -120,56 +250,132 @@ def compute_marker_cov(args, species, gene_to_cov, ref_to_species):
 		species_to_norm[species_id] = median(covs)
 	return species_to_norm
 
-def compute_pangenome_coverage(args, species):
-	""" Compute coverage of pangenome for species_id and write results to disk """
-	# map gene_id to species_id
-	ref_to_species = {}
-	for line in open('/'.join([args['outdir'], 'genes/temp/pangenomes.map'])):
-		gene_id, species_id = line.rstrip().split()
-		ref_to_species[gene_id] = species_id
-		
+def gene_ids_path(db, species_id):
+	""" Path to sorted centroid ids of species, which index sparse gene outputs """
+	for ext in ['', '.gz']:
+		inpath = '%s/pan_genomes/%s/gene_ids.txt%s' % (db, species_id, ext)
+		if os.path.isfile(inpath): return inpath
+	return '%s/pan_genomes/%s/gene_ids.txt' % (db, species_id)
+
+def write_gene_ids(db, species_id):
+	""" Write sorted ids of centroids.ffn to database; returns ids """
+	sp = Species(species_id)
+	sp.dir = '%s/pan_genomes/%s' % (db, species_id)
+	for ext in ['', '.gz']:
+		inpath = '%s/centroids.ffn%s' % (sp.dir, ext)
+		if os.path.isfile(inpath): sp.pan_genome = inpath
+	gene_ids = sorted([line[1:].split()[0] for line in utility.iopen(sp.pan_genome) if line[0] == '>'])
+	outpath = '%s/gene_ids.txt' % sp.dir
+	tmppath = '%s.%s' % (outpath, os.getpid())
+	with open(tmppath, 'w') as outfile:
+		outfile.write(''.join([_+'\n' for _ in gene_ids]))
+	os.rename(tmppath, outpath) # concurrent readers never see a partial file
+	return gene_ids
+
+def read_gene_ids(db, species_id):
+	""" Read sorted centroid ids of species from database, writing them from centroids.ffn if missing """
+	inpath = gene_ids_path(db, species_id)
+	if os.path.isfile(inpath):
+		return [line.rstrip('\n') for line in utility.iopen(inpath)]
+	elif os.access('%s/pan_genomes/%s' % (db, species_id), os.W_OK):
+		return write_gene_ids(db, species_id)
+	else:
+		sys.exit("\nError: Could not locate %s\nRun without --sparse or use a writable database" % inpath)
+
+def write_sparse(outpath, pangenome_size, index, coverage, copy_number, marker_coverage):
+	""" Write coverage and copy number of genes with nonzero coverage; index is position in gene_ids.txt """
+	import numpy as np
+	with open(outpath, 'wb') as outfile:
+		np.savez_compressed(outfile,
+			pangenome_size=np.array(pangenome_size, dtype=np.int64),
+			index=np.array(index, dtype=np.uint32),
+			coverage=np.array(coverage, dtype=np.float32),
+			copy_number=np.array(copy_number, dtype=np.float32),
+			marker_coverage=np.array(marker_coverage, dtype=np.float64))
+
+def read_sparse(inpath):
+	""" Read sparse gene output into dict of arrays """
+	import numpy as np
+	with np.load(inpath) as data:
+		return dict([(field, data[field]) for field in data.files])
+
+def compute_pangenome_coverage(args, species, gene_cov=None):
+	""" Compute coverage of pangenome for species_id and write results to disk
+		Coverage is counted from pangenomes.bam unless gene_cov was counted during alignment """
+	import numpy as np
 	# open outfiles for each species_id
 	outfiles = {}
 	for species_id in species:
+		if args['sparse']: continue
 		outpath = '/'.join([args['outdir'], 'genes/output/%s.genes.gz' % species_id])
 		outfiles[species_id] = utility.iopen(outpath, 'w')
 		outfiles[species_id].write('\t'.join(['gene_id', 'coverage', 'copy_number'])+'\n')
 	
 	# parse bam into cov files for each species_id
-	gene_to_cov = count_mapped_bp(args)
+	if gene_cov is None: gene_cov = count_mapped_bp(args)
+
+	# map gene_id to species_id
+	gene_species = read_gene_species(args, gene_cov.gene_ids)
 
 	# compute normalization factor
-	species_to_norm = compute_marker_cov(args, species, gene_to_cov, ref_to_species)
+	species_to_norm = compute_marker_cov(args, species, gene_cov, gene_species)
 
 	# write to output files
-	for gene_id in sorted(gene_to_cov):
-		cov = gene_to_cov[gene_id]
-		species_id = ref_to_species[gene_id]
-		outfile = outfiles[species_id]
-		normcov = cov/species_to_norm[species_id] if species_to_norm[species_id] > 0 else 0.0
-		outfile.write('\t'.join([str(x) for x in [gene_id, cov, normcov]])+'\n')
+	coverage = gene_cov.coverage()
+	norm = np.array([species_to_norm[_] for _ in gene_species])
+	normcov = np.where(norm > 0, coverage/np.where(norm > 0, norm, 1), 0.0)
+	order = np.argsort(np.array(gene_cov.gene_ids), kind='stable')
+	if args['sparse']:
+		write_sparse_coverage(args, species, gene_cov, gene_species, order, coverage, normcov, species_to_norm)
+		return
+	for index in order:
+		outfile = outfiles[gene_species[index]]
+		outfile.write('\t'.join([gene_cov.gene_ids[index], repr(coverage[index].item()), repr(normcov[index].item())])+'\n')
+
+def write_sparse_coverage(args, species, gene_cov, gene_species, order, coverage, normcov, species_to_norm):
+	""" Write sparse output per species with genes indexed by position in gene_ids.txt of database """
+	import numpy as np
+	# group sorted genes by species
+	codes = dict([(j,i) for i,j in enumerate(species)])
+	species_codes = np.array([codes[_] for _ in gene_species])[order]
+	order = order[np.argsort(species_codes, kind='stable')]
+	bounds = np.searchsorted(np.sort(species_codes), np.arange(len(codes) + 1))
+	for species_id, code in codes.items():
+		genes = order[bounds[code]:bounds[code+1]]
+		if read_gene_ids(args['db'], species_id) != [gene_cov.gene_ids[_] for _ in genes]:
+			sys.exit("\nError: Genes of species %s do not match %s" % (species_id, gene_ids_path(args['db'], species_id)))
+		index = np.flatnonzero(coverage[genes] > 0)
+		marker_coverage = species_to_norm[species_id] if (normcov[genes] > 0).any() else 0.0
+		outpath = '/'.join([args['outdir'], 'genes/output/%s.genes.npz' % species_id])
+		write_sparse(outpath, len(genes), index, coverage[genes][index], normcov[genes][index], marker_coverage)
 
 def remove_tmp(args):
 	""" Remove specified temporary files """
 	import shutil
 	shutil.rmtree('/'.join([args['outdir'], 'genes/temp']))
 
-def genes_summary(args):
+def genes_summary(args, species):
 	""" Get summary of mapping statistics """
 	# store stats
 	stats = {}
-	inpath = '%s/%s' % (args['outdir'], 'genes/temp/pangenomes.map')
-	for species_id in args['species_id']:
+	for species_id in species:
 		pangenome_size, covered_genes, total_coverage, marker_coverage = [0,0,0,0]
-		for r in utility.parse_file('/'.join([args['outdir'], 'genes/output/%s.genes.gz' % species_id])):
-			pangenome_size += 1
-			coverage = float(r['coverage'])
-			normcov = float(r['copy_number'])
-			if coverage > 0:
-				covered_genes += 1
-				total_coverage += coverage
-			if normcov > 0:
-				marker_coverage = coverage/normcov
+		if args['sparse']:
+			genes = read_sparse('/'.join([args['outdir'], 'genes/output/%s.genes.npz' % species_id]))
+			pangenome_size = int(genes['pangenome_size'])
+			covered_genes = len(genes['index'])
+			total_coverage = float(genes['coverage'].sum(dtype=float))
+			marker_coverage = float(genes['marker_coverage'])
+		else:
+			for r in utility.parse_file('/'.join([args['outdir'], 'genes/output/%s.genes.gz' % species_id])):
+				pangenome_size += 1
+				coverage = float(r['coverage'])
+				normcov = float(r['copy_number'])
+				if coverage > 0:
+					covered_genes += 1
+					total_coverage += coverage
+				if normcov > 0:
+					marker_coverage = coverage/normcov
 		stats[species_id] = {'pangenome_size':pangenome_size,
 							 'covered_genes':covered_genes,
 							 'fraction_covered':covered_genes/float(pangenome_size),
@@ -220,7 +426,7 @@ def initialize_species(args):
 				outfile.write(id+'\n')
 	elif os.path.isfile(splist):
 		for line in open(splist):
-			species[id] = Species(line.rstrip())
+			species[line.rstrip()] = Species(line.rstrip())
 	for sp in species.values():
 		sp.init_ref_db(args['db'])
 	return species
@@ -236,16 +442,23 @@ def run_pipeline(args):
 		print("\nBuilding pangenome database")
 		args['log'].write("\nBuilding pangenome database\n")
 		start = time()
-		build_pangenome_db(args, species)
+		if args['prebuilt']:
+			index_cache.link_prebuilt(args, 'genes', 'pangenomes', species.keys())
+		elif args['index_cache']:
+			sources = [(sp.id, sp.pan_genome) for sp in species.values()]
+			index_cache.fetch_database(args, 'genes', 'pangenomes', sources, lambda: build_pangenome_db(args, species))
+		else:
+			build_pangenome_db(args, species)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
 	# Use bowtie2 to align reads to pangenome database
+	gene_cov = None
 	if args['align']:
 		start = time()
 		print("\nAligning reads to pangenomes")
 		args['log'].write("\nAligning reads to pangenomes\n")
-		pangenome_align(args)
+		gene_cov = pangenome_align(args)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
@@ -254,8 +467,8 @@ def run_pipeline(args):
 		start = time()
 		print("\nComputing coverage of pangenomes")
 		args['log'].write("\nComputing coverage of pangenomes\n")
-		compute_pangenome_coverage(args, species)
-		genes_summary(args)
+		compute_pangenome_coverage(args, species, gene_cov)
+		genes_summary(args, species)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
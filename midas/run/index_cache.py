@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, shutil, tempfile, hashlib, json, glob, fcntl
+from midas import utility
+
+def cache_key(args, program, sources):
+	""" Hash of database version, MIDAS version, and sorted (species_id, source file) pairs
+		Database version is taken from the size and mtime of species_info.txt and of each source file """
+	def file_info(path):
+		st = os.stat(path)
+		return [os.path.realpath(path), st.st_size, int(st.st_mtime)]
+	key = {'midas':utility.__version__,
+		   'program':program,
+		   'db':file_info('%s/species_info.txt' % args['db']),
+		   'species':[[id] + file_info(path) for id, path in sorted(sources)]}
+	return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def database_files(dir, prefix):
+	""" FASTA, map, and bowtie2 index files of database named prefix """
+	paths = ['%s/%s.fa' % (dir, prefix), '%s/%s.map' % (dir, prefix)]
+	paths += sorted(glob.glob('%s/%s.*.bt2' % (dir, prefix)) + glob.glob('%s/%s.*.bt2l' % (dir, prefix)))
+	return paths
+
+def remove_database(dir, prefix):
+	""" Remove database files before rebuilding them; files may be hard-linked to a cached database """
+	for path in database_files(dir, prefix) + ['%s/%s.fa.fai' % (dir, prefix)]:
+		if os.path.lexists(path): os.remove(path)
+
+def link_files(paths, outdir):
+	""" Hard-link files into outdir; copy if outdir is on another file system """
+	for inpath in paths:
+		outpath = '%s/%s' % (outdir, os.path.basename(inpath))
+		if os.path.exists(outpath): os.remove(outpath)
+		try:
+			os.link(inpath, outpath)
+		except OSError:
+			shutil.copy(inpath, outpath)
+
+def entry_size(entry):
+	""" Total size of files in cache entry """
+	return sum([os.path.getsize('%s/%s' % (entry, _)) for _ in os.listdir(entry)])
+
+class KeyLock:
+	""" Exclusive lock on cache key held with flock on a lock file in the cache directory """
+	def __init__(self, cache_dir, key):
+		self.path = '%s/.%s.lock' % (cache_dir, key)
+
+	def acquire(self, blocking=True):
+		self.file = open(self.path, 'a')
+		try:
+			fcntl.flock(self.file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			self.file.close()
+			return False
+		return True
+
+	def release(self):
+		fcntl.flock(self.file, fcntl.LOCK_UN)
+		self.file.close()
+
+def evict(cache_dir, max_size, keep):
+	""" Remove least recently used entries until the cache is no larger than max_size bytes
+		Entries locked by other processes and the entry in use (keep) are skipped """
+	entries = []
+	for key in os.listdir(cache_dir):
+		entry = '%s/%s' % (cache_dir, key)
+		if key.startswith('.') or not os.path.isdir(entry): continue
+		entries.append([os.path.getmtime(entry), entry_size(entry), key])
+	total = sum([_[1] for _ in entries])
+	for used, size, key in sorted(entries):
+		if total <= max_size: break
+		if key == keep: continue
+		lock = KeyLock(cache_dir, key)
+		if not lock.acquire(blocking=False): continue
+		try:
+			shutil.rmtree('%s/%s' % (cache_dir, key), ignore_errors=True)
+			total -= size
+		finally:
+			lock.release()
+
+def fetch_database(args, program, prefix, sources, build):
+	""" Link cached database of selected species into <outdir>/<program>/temp, building and caching it if missing
+		build() writes the database to the temp directory; one process builds each key while others wait for it
+		Files are hard-linked, so evicting an entry does not affect runs that are using it """
+	cache_dir = '%s/%s' % (args['index_cache'], program)
+	outdir = '%s/%s/temp' % (args['outdir'], program)
+	if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+	key = cache_key(args, program, sources)
+	entry = '%s/%s' % (cache_dir, key)
+	lock = KeyLock(cache_dir, key)
+	lock.acquire()
+	try:
+		if os.path.isdir(entry):
+			print("  using cached database: %s" % entry)
+			args['log'].write("using cached database: %s\n" % entry)
+			link_files(database_files(entry, prefix), outdir)
+			os.utime(entry, None) # mark as recently used
+		else:
+			build()
+			print("  adding database to cache: %s" % entry)
+			args['log'].write("adding database to cache: %s\n" % entry)
+			tmpdir = tempfile.mkdtemp(dir=cache_dir, prefix='.%s.' % key)
+			os.chmod(tmpdir, 0o755) # cache may be shared
+			link_files(database_files(outdir, prefix), tmpdir)
+			os.rename(tmpdir, entry)
+	finally:
+		lock.release()
+	evict(cache_dir, args['cache_size'] * 1e9, keep=key)
+
+def prebuilt_dir(db):
+	""" Directory of bowtie2 databases of all species built by build_midas_db.py --bowtie2_index """
+	return '%s/bowtie2_indexes' % db
+
+def has_prebuilt(db, prefix):
+	""" Check that whole-database bowtie2 index named prefix exists """
+	return any([os.path.isfile('%s/%s.1.%s' % (prebuilt_dir(db), prefix, ext)) for ext in ['bt2', 'bt2l']])
+
+def link_prebuilt(args, program, prefix, species_ids):
+	""" Symlink whole-database FASTA and bowtie2 index into <outdir>/<program>/temp and write map of selected species
+		Alignments to references missing from the map are removed by filter_sam """
+	indir = prebuilt_dir(args['db'])
+	outdir = '%s/%s/temp' % (args['outdir'], program)
+	remove_database(outdir, prefix)
+	for inpath in database_files(indir, prefix)[:1] + database_files(indir, prefix)[2:]:
+		os.symlink(os.path.abspath(inpath), '%s/%s' % (outdir, os.path.basename(inpath)))
+	if os.path.isfile('%s/%s.fa.fai' % (indir, prefix)):
+		os.symlink(os.path.abspath('%s/%s.fa.fai' % (indir, prefix)), '%s/%s.fa.fai' % (outdir, prefix))
+	species_ids = set(species_ids)
+	stats = {'total_seqs':0, 'species':len(species_ids)}
+	with open('%s/%s.map' % (outdir, prefix), 'w') as outfile:
+		for line in open('%s/%s.map' % (indir, prefix)):
+			if line.rstrip('\n').split('\t')[1] in species_ids:
+				outfile.write(line)
+				stats['total_seqs'] += 1
+	print("  using prebuilt database: %s/%s" % (indir, prefix))
+	print("  total species: %s" % stats['species'])
+	print("  total sequences: %s" % stats['total_seqs'])
+	args['log'].write("using prebuilt database: %s/%s\n" % (indir, prefix))
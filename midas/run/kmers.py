@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import os, shutil, tempfile
+import numpy as np
+from midas import utility
+from midas.run import stream_seqs
+
+k = 31 # k-mer size; 2 bits per base fits in uint64
+
+base_codes = stream_seqs.base_codes # 2-bit code of each byte; 4 marks bases other than A, C, G, T
+
+def encode_kmers(seq, lengths):
+	""" Hash k-mers of concatenated sequences as canonical 2-bit integers
+		Returns hash of each k-mer without ambiguous bases and index of the sequence it came from """
+	codes = base_codes[np.frombuffer(seq, dtype=np.uint8)]
+	n = len(codes) - k + 1
+	if n <= 0:
+		return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+	seq_index = np.repeat(np.arange(len(lengths)), lengths)
+	ambiguous = np.concatenate([[0], np.cumsum(codes == 4)])
+	valid = (ambiguous[k:] == ambiguous[:-k]) & (seq_index[:n] == seq_index[k-1:])
+	forward = np.zeros(n, dtype=np.uint64)
+	reverse = np.zeros(n, dtype=np.uint64)
+	for j in range(k):
+		bases = codes[j:j+n].astype(np.uint64) & np.uint64(3)
+		forward = (forward << np.uint64(2)) | bases
+		reverse = reverse | ((np.uint64(3) - bases) << np.uint64(2*j))
+	return np.minimum(forward, reverse)[valid], seq_index[:n][valid]
+
+def index_dir(db):
+	""" Path to k-mer index stored next to phyeco.fa """
+	return '%s/marker_genes/phyeco.kmers' % db
+
+def source_files(db):
+	""" Database files that the k-mer index is built from """
+	return ['%s/species_info.txt' % db,
+			'%s/marker_genes/phyeco.fa' % db,
+			'%s/marker_genes/phyeco.map' % db]
+
+def is_current(db):
+	""" Check that k-mer index exists and is newer than the files it was built from """
+	paths = ['%s/%s.npy' % (index_dir(db), _) for _ in ['hashes', 'targets', 'k']]
+	if not all([os.path.isfile(_) for _ in paths]):
+		return False
+	if int(np.load(paths[2])) != k:
+		return False
+	built = min([os.path.getmtime(_) for _ in paths])
+	return all([os.path.getmtime(_) <= built for _ in source_files(db)])
+
+def unique_kmers(hashes, targets, species):
+	""" Keep k-mers found in a single species; returns sorted hashes and one target code per hash """
+	order = np.lexsort((species, hashes))
+	hashes, targets, species = hashes[order], targets[order], species[order]
+	# collapse to distinct (hash, species) pairs
+	first = np.concatenate([[True], (hashes[1:] != hashes[:-1]) | (species[1:] != species[:-1])])
+	hashes, targets = hashes[first], targets[first]
+	# drop hashes shared by 2 or more species
+	single = np.ones(len(hashes), dtype=bool)
+	shared = hashes[1:] == hashes[:-1]
+	single[1:] &= ~shared
+	single[:-1] &= ~shared
+	return hashes[single], targets[single]
+
+def compile_arrays(db, index):
+	""" Find k-mers unique to one species within each marker family of phyeco.fa """
+	names, seqs = [], []
+	infile = utility.iopen('%s/marker_genes/phyeco.fa' % db)
+	for name, seq, qual in stream_seqs.readfq(infile):
+		names.append(name.encode())
+		seqs.append(seq.upper().encode())
+	infile.close()
+	families = {}
+	for target, seq in zip(index.lookup(np.array(names, dtype=bytes)), seqs):
+		marker = index.target_marker[target]
+		if marker not in families: families[marker] = ([], [])
+		families[marker][0].append(seq)
+		families[marker][1].append(target)
+	all_hashes, all_targets = [], []
+	for marker in sorted(families):
+		seqs, targets = families[marker]
+		hashes, seq_index = encode_kmers(b''.join(seqs), [len(_) for _ in seqs])
+		targets = np.array(targets, dtype=np.int32)[seq_index]
+		hashes, targets = unique_kmers(hashes, targets, index.target_species[targets])
+		all_hashes.append(hashes)
+		all_targets.append(targets)
+	# k-mers must also be unique to one species across marker families
+	targets = np.concatenate(all_targets)
+	hashes, targets = unique_kmers(np.concatenate(all_hashes), targets, index.target_species[targets])
+	return {'hashes':hashes, 'targets':targets.astype(np.int32), 'k':np.array(k)}
+
+def build_index(db, index):
+	""" Build k-mer index and write it to the database
+		Arrays are written to a temporary directory and moved into place so concurrent readers never see a partial index """
+	arrays = compile_arrays(db, index)
+	tmpdir = tempfile.mkdtemp(dir='%s/marker_genes' % db, prefix='.phyeco.kmers.')
+	for field, values in arrays.items():
+		np.save('%s/%s.npy' % (tmpdir, field), values)
+	if os.path.isdir(index_dir(db)): shutil.rmtree(index_dir(db), ignore_errors=True)
+	try:
+		os.rename(tmpdir, index_dir(db))
+	except OSError: # index built by concurrent process
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	return arrays
+
+class KmerIndex:
+	""" Sorted hashes of species-unique k-mers in marker genes and the target code each came from """
+	def __init__(self, db, index):
+		if is_current(db):
+			arrays = dict([(field, np.load('%s/%s.npy' % (index_dir(db), field), mmap_mode='r')) for field in ['hashes', 'targets']])
+		elif os.access('%s/marker_genes' % db, os.W_OK):
+			print("  building k-mer index of marker genes")
+			arrays = build_index(db, index)
+		else: # read-only database
+			arrays = compile_arrays(db, index)
+		self.hashes = arrays['hashes']
+		self.targets = arrays['targets']
+
+	def lookup(self, hashes):
+		""" Return mask of hashes found in index and target code of each found hash """
+		if len(self.hashes) == 0:
+			return np.zeros(len(hashes), dtype=bool), np.zeros(0, dtype=np.int32)
+		pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+		found = self.hashes[pos] == hashes
+		return found, self.targets[pos[found]]
+
+def stream_reads(process, block_size=2**20):
+	""" Yield blocks of complete 2-line FASTA records streamed by stream_seqs """
+	remainder = b''
+	while True:
+		block = process.stdout.read(block_size)
+		if not block: break
+		block = remainder + block
+		index = block.rfind(b'\n>') + 1 # split before last record, which may be incomplete
+		remainder = block[index:]
+		if index > 0: yield block[:index]
+	if remainder: yield remainder
+
+def classify_reads(args, kmer_index, index, blocks):
+	""" Yield chunks of best hits: one row per read and species sharing the most k-mers with it
+		Read length is used as aligned bp """
+	n_species = len(index.species_ids)
+	i = 0
+	for block in blocks:
+		seqs = block.split(b'\n')[1::2]
+		i += len(seqs)
+		lengths = np.array([len(_) for _ in seqs], dtype=np.int64)
+		hashes, read_index = encode_kmers(b''.join(seqs), lengths)
+		found, targets = kmer_index.lookup(hashes)
+		read_index = read_index[found]
+		# count k-mer hits per read and species
+		keys, first, counts = np.unique(read_index * n_species + index.target_species[targets],
+			return_index=True, return_counts=True)
+		if len(keys) == 0: continue
+		reads = keys // n_species
+		starts = np.flatnonzero(np.concatenate([[True], reads[1:] != reads[:-1]]))
+		sizes = np.diff(np.append(starts, len(reads)))
+		max_counts = np.repeat(np.maximum.reduceat(counts, starts), sizes)
+		keep = (counts == max_counts) & (counts >= args['min_kmers'])
+		yield {'query': reads[keep], 'target': targets[first[keep]], 'aln': lengths[reads[keep]]}
+	print("  total reads: %s" % i)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import sys, os, shutil, tempfile
+import numpy as np
+from midas import utility
+
+# arrays stored in index; per-target arrays are ordered by sorted target (gene) id
+fields = ['targets', 'target_species', 'target_marker', 'target_cutoff', 'target_length',
+		  'species_ids', 'species_length', 'marker_ids']
+
+def index_dir(db):
+	""" Path to compiled marker index stored next to phyeco.fa """
+	return '%s/marker_genes/phyeco.index' % db
+
+def source_files(db):
+	""" Database files that the marker index is compiled from """
+	return ['%s/species_info.txt' % db,
+			'%s/marker_genes/phyeco.map' % db,
+			'%s/marker_genes/phyeco.mapping_cutoffs' % db]
+
+def is_current(db):
+	""" Check that marker index exists and is newer than the files it was compiled from """
+	paths = ['%s/%s.npy' % (index_dir(db), field) for field in fields]
+	if not all([os.path.isfile(_) for _ in paths]):
+		return False
+	built = min([os.path.getmtime(_) for _ in paths])
+	return all([os.path.getmtime(_) <= built for _ in source_files(db)])
+
+def compile_arrays(db):
+	""" Parse species_info.txt, phyeco.map, and phyeco.mapping_cutoffs into integer-coded arrays """
+	for inpath in source_files(db):
+		if not os.path.isfile(inpath): sys.exit("File not found: %s" % inpath)
+	# species codes
+	species_ids = [r['species_id'] for r in utility.parse_file(source_files(db)[0])]
+	species_code = dict([(j,i) for i,j in enumerate(species_ids)])
+	# marker cutoffs
+	cutoffs = {}
+	for line in open(source_files(db)[2]):
+		marker_id, min_pid = line.rstrip().split()
+		cutoffs[marker_id] = float(min_pid)
+	marker_ids = sorted(cutoffs)
+	marker_code = dict([(j,i) for i,j in enumerate(marker_ids)])
+	# marker genes
+	genes = sorted([(r['gene_id'], r['species_id'], r['marker_id'], int(r['gene_length']))
+		for r in utility.parse_file(source_files(db)[1])])
+	for gene_id, species_id, marker_id, gene_length in genes:
+		if species_id not in species_code:
+			sys.exit("\nError: species '%s' of marker gene '%s' not found in species_info.txt" % (species_id, gene_id))
+		if marker_id not in marker_code:
+			sys.exit("\nError: no mapping cutoff found for marker '%s' of gene '%s'" % (marker_id, gene_id))
+	arrays = {}
+	arrays['targets'] = np.array([_[0].encode() for _ in genes], dtype=bytes)
+	arrays['target_species'] = np.array([species_code[_[1]] for _ in genes], dtype=np.int32)
+	arrays['target_marker'] = np.array([marker_code[_[2]] for _ in genes], dtype=np.int32)
+	arrays['target_cutoff'] = np.array([cutoffs[_[2]] for _ in genes], dtype=np.float64)
+	arrays['target_length'] = np.array([_[3] for _ in genes], dtype=np.int64)
+	arrays['species_ids'] = np.array([_.encode() for _ in species_ids], dtype=bytes)
+	arrays['species_length'] = np.bincount(arrays['target_species'],
+		weights=arrays['target_length'], minlength=len(species_ids)).astype(np.int64)
+	arrays['marker_ids'] = np.array([_.encode() for _ in marker_ids], dtype=bytes)
+	return arrays
+
+def build_index(db):
+	""" Compile marker index and write it to the database
+		Arrays are written to a temporary directory and moved into place so concurrent readers never see a partial index """
+	arrays = compile_arrays(db)
+	tmpdir = tempfile.mkdtemp(dir='%s/marker_genes' % db, prefix='.phyeco.index.')
+	for field in fields:
+		np.save('%s/%s.npy' % (tmpdir, field), arrays[field])
+	if os.path.isdir(index_dir(db)): shutil.rmtree(index_dir(db), ignore_errors=True)
+	try:
+		os.rename(tmpdir, index_dir(db))
+	except OSError: # index built by concurrent process
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	return arrays
+
+class MarkerIndex:
+	""" Integer-coded lookup of marker genes in phyeco.fa """
+	def __init__(self, db):
+		if is_current(db):
+			arrays = dict([(field, np.load('%s/%s.npy' % (index_dir(db), field), mmap_mode='r')) for field in fields])
+		elif os.access('%s/marker_genes' % db, os.W_OK):
+			arrays = build_index(db)
+		else: # read-only database
+			arrays = compile_arrays(db)
+		for field in fields:
+			setattr(self, field, arrays[field])
+		self.species_ids = [_.decode() for _ in self.species_ids]
+		self.marker_ids = [_.decode() for _ in self.marker_ids]
+
+	def lookup(self, targets):
+		""" Convert array of target ids to integer target codes """
+		names, name_index = np.unique(targets, return_inverse=True)
+		codes = np.searchsorted(self.targets, names)
+		found = codes < len(self.targets)
+		found[found] = self.targets[codes[found]] == names[found]
+		if not found.all():
+			sys.exit("\nError: target '%s' not found in marker index" % names[~found][0].decode())
+		return codes[name_index]
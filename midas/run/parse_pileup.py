@@ -2,7 +2,40 @@
 
 # Parses pileup base string and returns the counts for all possible alleles
 
+import re
+
+read_starts = re.compile(r'\^.') # read start mark followed by mapping quality
+indels = re.compile(r'[+-](\d+)') # indel length followed by indel sequence
+
+def strip_indels(pileup):
+	""" Remove indels with their sequence in one pass; indel lengths may have any number of digits """
+	parts = []
+	pos = 0
+	match = indels.search(pileup)
+	while match:
+		parts.append(pileup[pos:match.start()])
+		pos = match.end() + int(match.group(1))
+		match = indels.search(pileup, pos)
+	parts.append(pileup[pos:])
+	return ''.join(parts)
+
 def parse_pileup(ref_allele, pileup):
+	""" Count reads supporting each allele in linear time; read ends, deletions and N are not counted
+		Read starts are removed first, as their mapping quality may be any character including '+' and '-' """
+	counts = {'A':0,'G':0,'C':0,'T':0,'-':[],'+':[]}
+	if '^' in pileup:
+		pileup = read_starts.sub('', pileup)
+	if '+' in pileup or '-' in pileup:
+		pileup = strip_indels(pileup)
+	pileup = pileup.upper()
+	for allele in 'ACGT':
+		counts[allele] = pileup.count(allele)
+	counts[ref_allele] += pileup.count('.') + pileup.count(',')
+	return counts
+
+def parse_pileup_slice(ref_allele, pileup):
+	""" Original parser which re-slices the pileup after each base and reads one digit of indel lengths
+		Kept as a reference for parse_pileup in test/test_midas.py and test/benchmark_pileup.py """
 	counts = {'A':0,'G':0,'C':0,'T':0,'-':[],'+':[]}
 	pileup = pileup.upper()
 	pileup = pileup.replace('$', '')
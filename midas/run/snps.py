@@ -7,23 +7,15 @@
 import sys, os, subprocess, shutil
 from time import time
 from midas import utility
+from midas.run import index_cache, build_fasta
 
 def build_genome_db(args, species):
 	""" Build FASTA and BT2 database of representative genomes """
-	import Bio.SeqIO
 	# fasta database
-	genomes_fasta = open('/'.join([args['outdir'], 'snps/temp/genomes.fa']), 'w')
-	genomes_map = open('/'.join([args['outdir'], 'snps/temp/genomes.map']), 'w')
-	db_stats = {'total_length':0, 'total_seqs':0, 'species':0}
-	for sp in species:
-		db_stats['species'] += 1
-		infile = utility.iopen(sp.rep_genome)
-		for r in Bio.SeqIO.parse(infile, 'fasta'):
-				genomes_fasta.write('>%s\n%s\n' % (r.id, str(r.seq).upper()))
-				genomes_map.write('%s\t%s\n' % (r.id, sp.id))
-				db_stats['total_length'] += len(r.seq)
-				db_stats['total_seqs'] += 1
-		infile.close()
+	outdir = '/'.join([args['outdir'], 'snps/temp'])
+	index_cache.remove_database(outdir, 'genomes')
+	sources = [(sp.id, sp.rep_genome) for sp in species]
+	db_stats = build_fasta.build_fasta(sources, outdir, 'genomes', args['threads'])
 	# print out database stats
 	print("  total genomes: %s" % db_stats['species'])
 	print("  total contigs: %s" % db_stats['total_seqs'])
@@ -47,8 +39,11 @@ def genome_align(args):
 	command += '--%s ' % args['speed'] # speed/sensitivity
 	command += '--threads %s ' % args['threads'] # threads
 	command += '-f ' if args['file_type'] == 'fasta' else '-q ' # input type
-	command += '-1 %s -2 %s '  % (args['m1'], args['m2']) if args['m2'] else '-U %s ' % args['m1'] # input reads
+	if utility.prefilter_reads(args): stream, (m1, m2) = utility.stream_filtered_reads(args, 'snps') # remove duplicate and low-quality reads
+	else: m1, m2 = args['m1'], args['m2']
+	command += '-1 %s -2 %s '  % (m1, m2) if m2 else '-U %s ' % m1 # input reads
 	# Pipe to samtools
+	if args['prebuilt']: command += '| python %s %s ' % (args['filter_sam'], '/'.join([args['outdir'], 'snps/temp/genomes.map'])) # keep alignments to selected species
 	command += '| %s view -b - ' % args['samtools'] # convert to bam
 	command += '| %s sort -f - %s ' % (args['samtools'], bam_path) # sort bam
 	# Run command
@@ -58,31 +53,100 @@ def genome_align(args):
 	print("  finished aligning")
 	print("  checking bamfile integrity")
 	utility.check_exit_code(process, command)
+	if utility.prefilter_reads(args): utility.finish_filtered_reads(args, 'snps', stream, [m1, m2])
 	utility.check_bamfile(args, bam_path)
 
-def pileup(args):
-	""" Filter alignments by % id, use samtools to create pileup, filter low quality bases """
-	# Stream bam, filter alignments
-	command = 'python %s ' % args['stream_bam']
-	command += '%s ' % os.path.join(args['outdir'], 'snps/temp/genomes.bam')
-	command += '/dev/stdout '
-	command += '%s ' % args['mapid']
-	command += '%s ' % args['readq']
-	command += '%s ' % args['mapq']
-	# Pipe to mpileup
-	command += '| %s mpileup '  % args['samtools']
+def filter_alignments(args):
+	""" Filter alignments by % id, read quality, and mapping quality, then index the filtered bamfile and genomes.fa for region queries
+		genomes.fa.fai is built here, before species are counted in parallel, unless it links to the index of a prebuilt database """
+	import pysam
+	from midas.run import stream_bam
+	inpath = os.path.join(args['outdir'], 'snps/temp/genomes.bam')
+	outpath = os.path.join(args['outdir'], 'snps/temp/genomes.filtered.bam')
+	args['log'].write('filtering alignments: %s\n' % outpath)
+	stream_bam.filter_bam(inpath, outpath, args['mapid'], args['readq'], args['mapq'])
+	pysam.index(outpath)
+	fasta = os.path.join(args['outdir'], 'snps/temp/genomes.fa')
+	if not os.path.islink(fasta+'.fai'): # never write through a link into the shared database
+		if os.path.exists(fasta+'.fai'): os.remove(fasta+'.fai')
+		pysam.faidx(fasta)
+
+def empty_counts(length):
+	""" Return zeroed arrays of depth and A/T/C/G counts for contig of length; uint16 holds depths capped at 10000 """
+	import numpy as np
+	return np.zeros(length, dtype=np.uint16), np.zeros((4, length), dtype=np.uint16)
+
+def mpileup_species(args, species_id, ref_seqs):
+	""" Yield contig id, sequence, depth and A/T/C/G counts of each contig in ref_seqs by parsing one samtools mpileup of the species' contigs
+		Reads of the contigs are fetched with the bamfile index by samtools view and piped to mpileup, which reports contigs in the order
+		of the bamfile header; a contig is complete once a later contig is reported, and contigs counted ahead of ref_seqs are held until their turn """
+	import pysam
+	from midas.run import parse_pileup
+	bampath = '%s/snps/temp/genomes.filtered.bam' % args['outdir']
+	errpath = '%s/snps/temp/%s.mpileup.err' % (args['outdir'], species_id)
+	bamfile = pysam.AlignmentFile(bampath, 'rb')
+	rank = dict([(ref_id, index) for index, ref_id in enumerate(bamfile.references)])
+	bamfile.close()
+	regions = sorted([ref_id for ref_id, seq in ref_seqs], key=lambda ref_id: rank[ref_id]) # mpileup input must stay sorted
+	command = '%s view -u %s %s 2> %s | ' % (args['samtools'], bampath, ' '.join(regions), errpath)
+	command += '%s mpileup '  % args['samtools']
 	command += '-d 10000 ' # set max depth
 	if not args['baq']: command += '-B ' # BAQ
 	if args['adjust_mq']: command += '-C 50 ' # adjust MQ
 	if not args['discard']: command += '-A ' # keep discordant read pairs
 	command += '-Q %s ' % (args['baseq']) # base quality filtering
 	command += '-f %s ' % ('%s/snps/temp/genomes.fa' % args['outdir']) # reference fna file
-	command += '- ' #   input bam file
-	command += '| gzip > %s ' % ('%s/snps/temp/genomes.mpileup.gz' % args['outdir']) # output file
-	# Run command
-	args['log'].write('command: '+command+'\n')
-	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	utility.check_exit_code(process, command)
+	command += '- ' # reads of species' contigs
+	command += '2>> %s' % errpath
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
+	lengths = dict([(ref_id, len(seq)) for ref_id, seq in ref_seqs])
+	counted = {}
+	current = None
+	index = 0 # next contig of ref_seqs to yield
+	for snp in parse_pileup.main(process.stdout):
+		if snp['ref_id'] != current:
+			current = snp['ref_id']
+			depth, atcg = counted[current] = empty_counts(lengths[current])
+			while index < len(ref_seqs) and rank[ref_seqs[index][0]] < rank[current]:
+				ref_id, seq = ref_seqs[index]
+				yield (ref_id, seq) + (counted.pop(ref_id) if ref_id in counted else empty_counts(len(seq)))
+				index += 1
+		pos = int(snp['ref_pos']) - 1
+		depth[pos] = snp['depth']
+		atcg[:, pos] = [snp['counts'][_] for _ in 'ATCG']
+	utility.check_stream_exit_code(process, command, errpath)
+	for ref_id, seq in ref_seqs[index:]:
+		yield (ref_id, seq) + (counted.pop(ref_id) if ref_id in counted else empty_counts(len(seq)))
+	os.remove(errpath)
+
+def pileup_contig(args, bamfile, fasta, ref_id, length):
+	""" Count depth and A/T/C/G alleles at each position of contig with the samtools pileup engine
+		Options match samtools mpileup in mpileup_species(): max depth, --baseq, --discard, --baq, and --adjust_mq """
+	depth, atcg = empty_counts(length)
+	for column in bamfile.pileup(ref_id, 0, length, truncate=True, stepper='samtools', fastafile=fasta,
+			max_depth=10000, min_base_quality=args['baseq'], ignore_orphans=args['discard'],
+			compute_baq=args['baq'], adjust_capq_threshold=50 if args['adjust_mq'] else 0):
+		pos = column.reference_pos
+		bases = ''.join(column.get_query_sequences()).upper()
+		depth[pos] = column.get_num_aligned()
+		atcg[:, pos] = [bases.count(_) for _ in 'ATCG']
+	return depth, atcg
+
+def pileup_species(args, species_id, ref_seqs):
+	""" Yield contig id, sequence, depth and A/T/C/G counts of each contig in ref_seqs from regions of the filtered bamfile
+		Contigs are counted one at a time as they are consumed, so only one contig's counts are held in memory
+		Alleles are counted with samtools mpileup with --mpileup, and with pysam otherwise """
+	if args['mpileup']:
+		for contig in mpileup_species(args, species_id, ref_seqs):
+			yield contig
+	else:
+		import pysam
+		bamfile = pysam.AlignmentFile(os.path.join(args['outdir'], 'snps/temp/genomes.filtered.bam'), 'rb')
+		fasta = pysam.FastaFile(os.path.join(args['outdir'], 'snps/temp/genomes.fa'))
+		for ref_id, seq in ref_seqs:
+			yield (ref_id, seq) + pileup_contig(args, bamfile, fasta, ref_id, len(seq))
+		bamfile.close()
+		fasta.close()
 
 def read_ref_to_species(args):
 	ref_to_species = {}
@@ -92,76 +156,75 @@ def read_ref_to_species(args):
 		ref_to_species[ref_id] = species_id
 	return ref_to_species
 
-def split_pileup(args):
-	""" Split pileup into files per-species for easy parsing """
-	ref_to_species = read_ref_to_species(args)
-	# open outfiles for each species_id
-	outdir = '/'.join([args['outdir'], 'snps/temp/mpileup'])
-	if not os.path.isdir(outdir): os.mkdir(outdir)
-	outfiles = {}
-	for species_id in set(ref_to_species.values()):
-		outpath = '%s/%s.mpileup.gz' % (outdir, species_id)
-		outfiles[species_id] = utility.iopen(outpath, 'w')
-	# parse pileup into temorary files for each species_id
-	pileup_path = '%s/snps/temp/genomes.mpileup.gz' % args['outdir']
-	for line in utility.iopen(pileup_path):
-		species_id = ref_to_species[line.split()[0]]
-		outfiles[species_id].write(line)
-	# close outfiles
-	for file in outfiles.values():
-		file.close()
-
-def read_ref_bases(sp):
-	""" Read in reference genome by position """
+def read_ref_seqs(sp):
+	""" Read in reference genome as list of (contig id, upper-case sequence) sorted by id """
 	import Bio.SeqIO
-	ref = []
 	infile = utility.iopen(sp.rep_genome)
-	for rec in Bio.SeqIO.parse(infile, 'fasta'):
-		for pos in range(1, len(rec.seq)+1):
-			ref.append([rec.id, pos, rec.seq[pos-1].upper()])
+	ref = [(rec.id, str(rec.seq).upper()) for rec in Bio.SeqIO.parse(infile, 'fasta')]
+	infile.close()
 	return sorted(ref)
 
-def write_snp_record(outfile, snp=None, ref=None, header=False):
-	""" Write record for formatted SNP file """
+def write_snp_records(outfile, ref_id, seq, depth, atcg, batch_size=100000):
+	""" Write formatted SNP record for each position of contig from arrays of depth and A/T/C/G counts
+		Positions with a reference base other than A/T/C/G are written with depth 0 """
+	import numpy as np
+	codes = np.full(256, -1, dtype=np.int64)
+	for index, allele in enumerate('ATCG'): codes[ord(allele)] = index
+	alleles = np.array(list('ATCG'))
+	for start in range(0, len(seq), batch_size):
+		stop = min(start + batch_size, len(seq))
+		ref = codes[np.frombuffer(seq[start:stop].encode(), dtype=np.uint8)]
+		valid = ref >= 0
+		sites = np.arange(stop - start)
+		depth_batch = np.where(valid, depth[start:stop], 0)
+		counts = np.where(valid, atcg[:, start:stop], 0)
+		ref_count = counts[np.maximum(ref, 0), sites]
+		ref_freq = np.where(depth_batch > 0, ref_count / np.maximum(depth_batch, 1).astype(float), 0.0)
+		alt_counts = counts.astype(np.int32) # signed, as reference alleles are set to -1
+		alt_counts[ref[valid], sites[valid]] = -1 # alternate allele is most common non-reference allele
+		alt = alt_counts.argmax(axis=0)
+		alt = np.where(alt_counts[alt, sites] > 0, alleles[alt], 'NA')
+		records = zip(range(start + 1, stop + 1), seq[start:stop], alt.tolist(), ref_freq.tolist(), depth_batch.tolist(), counts.T.tolist())
+		outfile.write(''.join(['%s\t%s\t%s\t%s\t%s\t%s\t%s,%s,%s,%s\n' % tuple([ref_id, pos, ref_allele, alt_allele, freq, d] + c)
+			for pos, ref_allele, alt_allele, freq, d, c in records]))
+
+def format_species(args, sp):
+	""" Count alleles and write formatted record for every position of species' genome """
 	fields = ['ref_id', 'ref_pos', 'ref_allele', 'alt_allele', 'ref_freq', 'depth', 'count_atcg']
-	if header: # just write header
-		outfile.write('\t'.join(fields)+'\n')
-	elif ref: # missing snp
-		snp = {'ref_id': ref[0], 'ref_pos': str(ref[1]), 'ref_allele': ref[2], 'alt_allele': 'NA',
-			   'depth': 0, 'ref_freq': 0.0, 'count_atcg':'0,0,0,0'}
-		record = [str(snp[field]) for field in fields]
-		outfile.write('\t'.join(record)+'\n')
-	else: # present snp
-		record = [str(snp[field]) for field in fields]
-		outfile.write('\t'.join(record)+'\n')
+	ref_seqs = read_ref_seqs(sp)
+	outfile = utility.iopen('/'.join([args['outdir'], 'snps/output/%s.snps.gz' % sp.id]), 'w')
+	outfile.write('\t'.join(fields)+'\n')
+	for ref_id, seq, depth, atcg in pileup_species(args, sp.id, ref_seqs):
+		write_snp_records(outfile, ref_id, seq, depth, atcg)
+	outfile.close()
+
+def format_species_job(args, sp):
+	""" Run format_species in a pool process; errors are returned, as sys.exit would leave the pool waiting """
+	try:
+		format_species(args, sp)
+	except SystemExit as error:
+		return str(error)
 
 def format_pileup(args, species):
-	""" Parse mpileups and fill in missing positions """
-	import parse_pileup
-	ref_to_species = read_ref_to_species(args)
-	for sp in species:
-		# open outfile
-		outpath = '/'.join([args['outdir'], 'snps/output/%s.snps.gz' % sp.id])
-		outfile = utility.iopen(outpath, 'w')
-		write_snp_record(outfile, header=True)
-		# read sorted reference
-		ref = read_ref_bases(sp)
-		ref_index = 0
-		ref_length = len(ref)
-		# write formatted records
-		pileup_path = '/'.join([args['outdir'], 'snps/temp/mpileup/%s.mpileup.gz' % sp.id])
-		pileup_file = utility.iopen(pileup_path)
-		for snp in parse_pileup.main(pileup_file):
-			while [snp['ref_id'], int(snp['ref_pos'])] != ref[ref_index][0:2]: # fill in missing snp positions
-				write_snp_record(outfile, None, ref[ref_index]) # write missing record
-				ref_index += 1
-			write_snp_record(outfile, snp, None) # write present record
-			ref_index += 1
-		while ref_index < ref_length: # fill in trailing snps
-			write_snp_record(outfile, None, ref[ref_index]) # write trailing record
-			ref_index += 1
-		pileup_file.close()
-	shutil.rmtree('%s/snps/temp/mpileup' % args['outdir'])
+	""" Count alleles and write formatted records of each species
+		With multiple threads, species are processed in parallel by a pool of processes, largest genomes first """
+	pileup_args = dict([(_, args[_]) for _ in ['outdir', 'samtools', 'mpileup', 'baseq', 'discard', 'baq', 'adjust_mq']])
+	threads = int(args['threads'])
+	if threads > 1 and len(species) > 1:
+		from multiprocessing import Pool
+		pool = Pool(threads)
+		species = sorted(species, key=lambda sp: os.path.getsize(sp.rep_genome), reverse=True)
+		results = [pool.apply_async(format_species_job, (pileup_args, sp)) for sp in species]
+		for result in results:
+			error = result.get()
+			if error:
+				pool.terminate()
+				sys.exit(error)
+		pool.close()
+		pool.join()
+	else:
+		for sp in species:
+			format_species(pileup_args, sp)
 
 def snps_summary(args):
 	""" Get summary of mapping statistics """
@@ -231,7 +294,13 @@ def run_pipeline(args):
 		print("\nBuilding database of representative genomes")
 		args['log'].write("\nBuilding database of representative genomes\n")
 		start = time()
-		build_genome_db(args, species)
+		if args['prebuilt']:
+			index_cache.link_prebuilt(args, 'snps', 'genomes', [sp.id for sp in species])
+		elif args['index_cache']:
+			sources = [(sp.id, sp.rep_genome) for sp in species]
+			index_cache.fetch_database(args, 'snps', 'genomes', sources, lambda: build_genome_db(args, species))
+		else:
+			build_genome_db(args, species)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
@@ -245,19 +314,19 @@ def run_pipeline(args):
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
-	# Use mpileup to identify SNPs
+	# Count alleles at each position of each species with pysam or mpileup
 	if args['call']:
 		start = time()
-		print("\nRunning mpileup")
-		args['log'].write("\nRunning mpileup\n")
-		pileup(args)
+		print("\nFiltering alignments")
+		args['log'].write("\nFiltering alignments\n")
+		filter_alignments(args)
 		print("  %s minutes" % round((time() - start)/60, 2) )
 		print("  %s Gb maximum memory" % utility.max_mem_usage())
 
-	# Split pileup into files for each species, format, and report summary statistics
-		print("\nFormatting output")
-		args['log'].write("\nFormatting output\n")
-		split_pileup(args)
+	# Count alleles in each species' genome, format, and report summary statistics
+		start = time()
+		print("\nCounting alleles%s" % (" with mpileup" if args['mpileup'] else ""))
+		args['log'].write("\nCounting alleles%s\n" % (" with mpileup" if args['mpileup'] else ""))
 		format_pileup(args, species)
 		snps_summary(args)
 		print("  %s minutes" % round((time() - start)/60, 2) )
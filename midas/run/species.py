@@ -7,31 +7,34 @@
 import sys, os, subprocess
 from time import time
 from midas import utility
-from operator import itemgetter
-
-def read_annotations(args):
-	info = {}
-	inpath = '%s/species_info.txt' % args['db']
-	for r in utility.parse_file(inpath):
-		info[r['species_id']] = r
-	return info
-
-def read_marker_info(args):
-	info = {}
-	inpath = '%s/marker_genes/phyeco.map' % args['db']
-	for r in utility.parse_file(inpath):
-		info[r['gene_id']] = r
-	return info
-
-def map_reads_hsblast(args):
-	""" Use hs-blastn to map reads in fasta file to marker database """
-	# stream sequences
+from midas.run import marker_index, kmers
+
+def stream_command(args, m1, m2, outdir, tag=None):
+	""" Command to stream sequences from fasta/fastq file(s) """
 	command = 'python %s' % args['stream_seqs']
-	command += ' -1 %s' % args['m1'] # fasta/fastq
-	if args['m2']: command += ' -2 %s' % args['m2'] # mate
+	command += ' -1 %s' % m1 # fasta/fastq
+	if m2: command += ' -2 %s' % m2 # mate
 	if args['max_reads']: command += ' -n %s' % args['max_reads'] # number of reads
+	if args['sample_frac']: command += ' -f %s -s %s' % (args['sample_frac'], args['seed']) # uniform sample
+	if args['sample_reads']: command += ' -r %s -s %s' % (args['sample_reads'], args['seed']) # uniform sample of exact size
+	if args['dedup']: command += ' -d %s' % args['dedup_mem'] # remove duplicate reads
+	if args['readq'] is not None: command += ' -q %s' % args['readq'] # remove low-quality reads
+	if args['dust'] is not None: command += ' -c %s' % args['dust'] # remove low-complexity reads
 	if args['read_length']: command += ' -l %s' % args['read_length'] # read length
-	command += ' 2> %s/species/temp/read_count.txt' % args['outdir'] # tmpfile to store # of reads, bp sampled
+	if tag is not None: command += ' -t %s' % tag # tag read names with sample
+	command += ' 2> %s/species/temp/read_count.txt' % outdir # tmpfile to store # of reads, bp sampled
+	return command
+
+def map_reads_hsblast(args, samples=None):
+	""" Use hs-blastn to map reads in fasta file to marker database
+		Alignments are written to stdout of the returned process and classified as they are produced
+		If samples are given, reads from all samples are tagged with the sample index and aligned together """
+	# stream sequences
+	if samples is None:
+		command = stream_command(args, args['m1'], args['m2'], args['outdir'])
+	else:
+		command = '( %s; )' % '; '.join([stream_command(args, sample['m1'], sample['m2'], sample['outdir'], tag)
+			for tag, sample in enumerate(samples)])
 	# hs-blastn
 	command += ' | %s align' % args['hs-blastn']
 	command += ' -word_size %s' % args['word_size']
@@ -39,136 +42,314 @@ def map_reads_hsblast(args):
 	command += ' -db %s/marker_genes/phyeco.fa' % args['db']
 	command += ' -outfmt 6'
 	command += ' -num_threads %s' % args['threads']
-	command += ' -out %s/species/temp/alignments.m8' % args['outdir']
+	command += ' -out /dev/stdout'
 	command += ' -evalue 1e-3'
 	args['log'].write('command: '+command+'\n')
-	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	utility.check_exit_code(process, command)
-
-def parse_blast(inpath):
-	""" Yield formatted record from BLAST m8 file """
-	formats = [str,str,float,int,float,float,float,float,float,float,float,float]
-	fields = ['query','target','pid','aln','mis','gaps','qstart','qend','tstart','tend','evalue','score']
-	for line in open(inpath):
-		values = line.rstrip().split()
-		yield dict([(field, format(value)) for field, format, value in zip(fields, formats, values)])
-
-def query_coverage(aln):
-	""" Compute alignment coverage of query """
-	qlen = aln['query'].split('_')[-1] # get qlen from sequence header
-	return float(aln['aln'])/int(qlen)
-
-def find_best_hits(args, marker_info):
-	""" Find top scoring alignment for each read """
-	best_hits = {}
-	marker_cutoffs = get_markers(args)
+	errfile = open('%s/species/temp/hs-blastn.err' % args['outdir'], 'w') # avoid filling stderr pipe while streaming
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=errfile, start_new_session=True) # own process group so pipeline can be stopped early
+	errfile.close()
+	return process, command
+
+def stream_reads(args):
+	""" Stream reads without aligning them; used to classify reads by k-mers """
+	command = stream_command(args, args['m1'], args['m2'], args['outdir'])
+	args['log'].write('command: '+command+'\n')
+	errfile = open('%s/species/temp/stream_seqs.err' % args['outdir'], 'w')
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=errfile, start_new_session=True)
+	errfile.close()
+	return process, command
+
+def stop_stream(process):
+	""" Stop reading and classifying once abundances have converged """
+	import signal
+	process.stdout.close()
+	try: os.killpg(process.pid, signal.SIGTERM)
+	except OSError: pass # pipeline already finished
+	process.wait()
+
+def stream_alignments(args, process, block_size=2**20):
+	""" Yield blocks of complete lines of BLAST m8 output from running hs-blastn; optionally keep a copy on disk """
+	outfile = open('%s/species/temp/alignments.m8' % args['outdir'], 'wb') if args['keep_m8'] else None
+	remainder = b''
+	try:
+		while True:
+			block = process.stdout.read(block_size)
+			if not block: break
+			if outfile: outfile.write(block)
+			block = remainder + block
+			index = block.rfind(b'\n') + 1 # split after last complete line
+			remainder = block[index:]
+			if index > 0: yield block[:index]
+		if remainder: yield remainder
+	finally:
+		if outfile: outfile.close()
+
+def parse_blast_chunks(blocks, index):
+	""" Yield columns of BLAST m8 records used for classification as NumPy arrays
+		Only query, target, pid, aln, and score are parsed; read length is taken from the query name
+		Target ids are replaced with integer codes from marker index """
+	import numpy as np
+	for block in blocks:
+		values = np.array(block.split()).reshape(-1, 12)
+		if len(values) == 0: continue
+		yield {'query': values[:,0],
+			   'target': index.lookup(values[:,1]),
+			   'pid': values[:,2].astype(float),
+			   'aln': values[:,3].astype(int),
+			   'score': values[:,11].astype(float),
+			   'qlen': np.char.rpartition(values[:,0], b'_')[:,2].astype(int)} # get qlen from sequence header
+
+# columns of compact alignment store and their on-disk types
+store_fields = [('query', 'int64'), ('target', 'int32'), ('pid', 'float64'),
+				('aln', 'int32'), ('qlen', 'int32'), ('score', 'float32')]
+
+def store_dir(args):
+	""" Path to compact alignment store written with --keep_alignments and read by --reclassify """
+	return '%s/species/temp/alignments' % args['outdir']
+
+def write_store(args, index, chunks):
+	""" Save columns of alignment chunks to compact binary store while passing chunks through
+		Query names are replaced with integer indexes in order of appearance """
+	import numpy as np, shutil
+	outdir = store_dir(args)
+	if os.path.isdir(outdir): shutil.rmtree(outdir)
+	os.makedirs(outdir)
+	np.save('%s/targets.npy' % outdir, index.targets) # marker index targets codes refer to
+	outfiles = dict([(field, open('%s/%s.bin' % (outdir, field), 'wb')) for field, dtype in store_fields])
+	last_query, last_index = None, -1
+	try:
+		for chunk in chunks:
+			query = chunk['query']
+			query_index = last_index + np.cumsum(np.concatenate([[query[0] != last_query], query[1:] != query[:-1]]))
+			last_query, last_index = query[-1], query_index[-1]
+			for field, dtype in store_fields:
+				values = query_index if field == 'query' else chunk[field]
+				values.astype(dtype).tofile(outfiles[field])
+			yield chunk
+	finally:
+		for outfile in outfiles.values(): outfile.close()
+
+def read_store(args, index, chunk_size=2**20):
+	""" Yield chunks of alignments from compact binary store """
+	import numpy as np
+	indir = store_dir(args)
+	if not os.path.isfile('%s/targets.npy' % indir):
+		sys.exit("\nError: Could not locate stored alignments: %s\nTo store alignments for --reclassify, run with --keep_alignments" % indir)
+	targets = np.load('%s/targets.npy' % indir)
+	if len(targets) != len(index.targets) or not (targets == index.targets).all():
+		sys.exit("\nError: Stored alignments were made with a different marker database\nRerun without --reclassify to align reads")
+	if os.path.getsize('%s/query.bin' % indir) == 0:
+		return
+	columns = dict([(field, np.memmap('%s/%s.bin' % (indir, field), dtype=dtype, mode='r')) for field, dtype in store_fields])
+	for start in range(0, len(columns['query']), chunk_size):
+		yield dict([(field, np.array(values[start:start+chunk_size])) for field, values in columns.items()])
+
+def subset_chunk(chunk, rows):
+	""" Select rows from each column of chunk """
+	return dict([(field, values[rows]) for field, values in chunk.items()])
+
+def concat_chunks(chunk1, chunk2):
+	""" Concatenate columns of two chunks """
+	import numpy as np
+	return dict([(field, np.concatenate([chunk1[field], chunk2[field]])) for field in chunk1])
+
+def group_starts(query):
+	""" Find index of first row for each group of adjacent rows with the same query """
+	import numpy as np
+	return np.flatnonzero(np.concatenate([[True], query[1:] != query[:-1]]))
+
+def select_best_hits(chunk):
+	""" Keep top scoring alignment(s) within each query group of chunk """
+	import numpy as np
+	starts = group_starts(chunk['query'])
+	sizes = np.diff(np.append(starts, len(chunk['query'])))
+	max_scores = np.repeat(np.maximum.reduceat(chunk['score'], starts), sizes)
+	return subset_chunk(chunk, chunk['score'] == max_scores)
+
+def find_best_hits(args, index, chunks):
+	""" Yield top scoring alignment(s) for reads in chunks of BLAST output
+		hs-blastn reports all hits for a query together, so only the last query of a chunk is carried to the next """
 	i = 0
-	qcovs = []
-	for aln in parse_blast('%s/species/temp/alignments.m8' % args['outdir']):
-		i += 1
-		marker_id = marker_info[aln['target']]['marker_id'] # get gene family from marker_info
-		cutoff = args['mapid'] if args['mapid'] else marker_cutoffs[marker_id]
-		if aln['pid'] < cutoff: # does not meet marker cutoff
-			continue
-		elif query_coverage(aln) < args['aln_cov']: # filter local alignments
-			continue
-		elif aln['query'] not in best_hits: # record aln
-			best_hits[aln['query']] = [aln]
-		elif best_hits[aln['query']][0]['score'] == aln['score']: # add aln
-			best_hits[aln['query']] += [aln]
-		elif best_hits[aln['query']][0]['score'] < aln['score']: # update aln
-			best_hits[aln['query']] = [aln]
+	carry = None
+	for chunk in chunks:
+		i += len(chunk['query'])
+		cutoffs = args['mapid'] if args['mapid'] else index.target_cutoff[chunk['target']]
+		# filter alignments that do not meet marker cutoff or are local alignments
+		keep = ((chunk['pid'] >= cutoffs)
+				& (chunk['aln'] / chunk['qlen'] >= args['aln_cov']))
+		chunk = subset_chunk(chunk, keep)
+		if carry is not None: chunk = concat_chunks(carry, chunk)
+		if len(chunk['query']) == 0: continue
+		# hold back last query, which may continue in next chunk
+		last = group_starts(chunk['query'])[-1]
+		carry = subset_chunk(chunk, slice(last, None))
+		if last > 0: yield select_best_hits(subset_chunk(chunk, slice(0, last)))
+	if carry is not None and len(carry['query']) > 0: yield select_best_hits(carry)
 	print("  total alignments: %s" % i)
-	return best_hits.values()
-
-def assign_unique(args, alns, species_info, marker_info):
-	""" Count the number of uniquely mapped reads to each genome species """
-	unique_alns = dict([(_,[]) for _ in species_info])
-	unique = 0
-	non_unique = 0
-	for aln in alns:
-		if len(aln) == 1:
-			unique += 1
-			#species_id = aln[0]['target'].split('_')[0]
-			species_id = marker_info[aln[0]['target']]['species_id']
-			unique_alns[species_id].append(aln[0])
-		else:
-			non_unique += 1
-	print("  uniquely mapped reads: %s" % unique)
-	print("  ambiguously mapped reads: %s" % non_unique)
-	return unique_alns
 
-def assign_non_unique(args, alns, unique_alns, marker_info):
-	""" Probabalistically assign ambiguously mapped reads """
+def init_species_counts(n):
+	""" Initialize accumulators of mapped reads and aligned bp indexed by species code """
+	import numpy as np
+	return {'count':np.zeros(n, dtype=np.int64), 'bp':np.zeros(n, dtype=np.int64)}
+
+def add_non_unique(non_unique, species, bps):
+	""" Record ambiguously mapped reads under their candidate set of species codes
+		species and bps are 2d arrays with one row per read and one column per top hit """
+	from array import array
+	import numpy as np
+	order = np.argsort(species, axis=1, kind='mergesort')
+	rows = np.arange(len(species))[:,None]
+	species, bps = species[rows, order], bps[rows, order]
+	for key, values in zip(map(tuple, species.tolist()), bps.tolist()):
+		if key not in non_unique: non_unique[key] = array('l')
+		non_unique[key].extend(values)
+
+def count_best_hits(chunk, index, unique_counts, non_unique):
+	""" Add uniquely mapped reads in chunk to species counts and record ambiguously mapped reads """
+	import numpy as np
+	species = index.target_species[chunk['target']]
+	starts = group_starts(chunk['query'])
+	sizes = np.diff(np.append(starts, len(chunk['query'])))
+	# uniquely mapped reads
+	unique = starts[sizes == 1]
+	unique_counts['count'] += np.bincount(species[unique], minlength=len(index.species_ids))
+	unique_counts['bp'] += np.bincount(species[unique], weights=chunk['aln'][unique], minlength=len(index.species_ids)).astype(np.int64)
+	# ambiguously mapped reads, batched by number of top hits
+	for size in np.unique(sizes[sizes > 1]):
+		rows = starts[sizes == size][:,None] + np.arange(size)
+		add_non_unique(non_unique, species[rows], chunk['aln'][rows])
+
+def count_non_unique(non_unique):
+	""" Number of ambiguously mapped reads """
+	return sum([len(bps)//len(key) for key, bps in non_unique.items()])
+
+def assign_unique(args, best_hits, index, convergence=None):
+	""" Count the number of uniquely mapped reads and aligned bp for each genome species
+		Ambiguously mapped reads are returned as a dict mapping each tuple of candidate species codes
+		to a flat array of aligned bp per read and candidate
+		If convergence is given, stop consuming alignments once species abundances have converged """
+	unique_counts = init_species_counts(len(index.species_ids))
+	non_unique = {}
+	for chunk in best_hits:
+		count_best_hits(chunk, index, unique_counts, non_unique)
+		if convergence and convergence.update(args, index, unique_counts, non_unique):
+			break
+	print("  uniquely mapped reads: %s" % unique_counts['count'].sum())
+	print("  ambiguously mapped reads: %s" % count_non_unique(non_unique))
+	return unique_counts, non_unique
+
+def demultiplex(chunk):
+	""" Split chunk of alignments into (sample index, chunk) using sample tag of query names """
+	import numpy as np
+	samples = np.char.partition(chunk['query'], b'|')[:,0].astype(int)
+	starts = group_starts(samples)
+	ends = np.append(starts[1:], len(samples))
+	for start, end in zip(starts, ends):
+		yield samples[start], subset_chunk(chunk, slice(start, end))
+
+def assign_unique_cohort(args, best_hits, index, samples):
+	""" Count uniquely mapped reads and record ambiguously mapped reads separately for each sample """
+	for sample in samples:
+		sample['unique_counts'] = init_species_counts(len(index.species_ids))
+		sample['non_unique'] = {}
+	for chunk in best_hits:
+		for sample_index, sample_chunk in demultiplex(chunk):
+			sample = samples[sample_index]
+			count_best_hits(sample_chunk, index, sample['unique_counts'], sample['non_unique'])
+	for sample in samples:
+		print("  %s: %s uniquely and %s ambiguously mapped reads" % (sample['sample_id'],
+			sample['unique_counts']['count'].sum(), count_non_unique(sample['non_unique'])))
+
+class Convergence:
+	""" Track relative abundance of top species as reads are classified
+		Ambiguously mapped reads are assigned once, when first seen, and kept as running totals """
+	def __init__(self, args):
+		import numpy as np
+		self.step = args['converge_step']
+		self.topn = args['converge_topn']
+		self.tol = args['converge']
+		self.next_check = self.step
+		self.rel_abun = None
+		self.converged = False
+		self.rng = np.random.RandomState(args['seed'])
+		self.assigned = None # counts and bp of ambiguously mapped reads assigned so far
+		self.consumed = {} # number of values of each key of non_unique already assigned
+
+	def update(self, args, index, unique_counts, non_unique):
+		""" Re-estimate abundances every step classified reads; return True once top species change by < tol
+			Only ambiguously mapped reads added since the last estimate are assigned """
+		import numpy as np
+		reads = unique_counts['count'].sum() + count_non_unique(non_unique)
+		if reads < self.next_check:
+			return False
+		self.next_check = reads + self.step
+		if self.assigned is None: self.assigned = init_species_counts(len(index.species_ids))
+		for key in sorted(non_unique):
+			start = self.consumed.get(key, 0)
+			if start < len(non_unique[key]):
+				assign_reads(self.rng, self.assigned, unique_counts, key, non_unique[key][start:])
+				self.consumed[key] = len(non_unique[key])
+		species_counts = dict([(_, unique_counts[_] + self.assigned[_]) for _ in unique_counts])
+		rel_abun = normalize_counts(species_counts, index.species_length, verbose=False)['rel_abun']
+		if self.rel_abun is not None:
+			top = np.argsort(-rel_abun, kind='mergesort')[0:self.topn]
+			change = np.abs(rel_abun[top] - self.rel_abun[top]).max()
+			if change < self.tol:
+				self.converged = True
+				print("  relative abundances converged after %s classified reads" % reads)
+		self.rel_abun = rel_abun
+		return self.converged
+
+def assign_reads(rng, species_counts, unique_counts, key, bps):
+	""" Add ambiguously mapped reads with candidate species codes key to species_counts
+		Reads are assigned in one draw in proportion to uniquely mapped reads; bps is a flat array of aligned bp per read and candidate """
+	import numpy as np
+	species = np.array(key)
+	bps = np.array(bps).reshape(-1, len(key))
+	counts = unique_counts['count'][species].astype(float)
+	if counts.sum() == 0:
+		probs = np.repeat(1.0/len(counts), len(counts))
+	else:
+		probs = counts/counts.sum()
+	choices = rng.choice(len(species), size=len(bps), p=probs)
+	np.add.at(species_counts['count'], species[choices], 1)
+	np.add.at(species_counts['bp'], species[choices], bps[np.arange(len(bps)), choices])
+
+def assign_non_unique(args, non_unique, unique_counts):
+	""" Probabalistically assign ambiguously mapped reads in proportion to uniquely mapped reads
+		Reads with the same candidate species are assigned together in one draw from a seeded generator """
+	import numpy as np
+	rng = np.random.RandomState(args['seed'])
+	species_counts = dict([(i, j.copy()) for i, j in unique_counts.items()])
+	for key in sorted(non_unique):
+		assign_reads(rng, species_counts, unique_counts, key, non_unique[key])
+	return species_counts
+
+def normalize_counts(species_counts, total_gene_length, verbose=True):
+	""" Normalize counts by gene length and sum contrain
+		Returns arrays of read count, coverage, and relative abundance indexed by species code """
 	import numpy as np
-	import random
-	total_alns = unique_alns.copy()
-	for aln in alns:
-		if len(aln) > 1:
-			species_ids = [marker_info[_['target']]['species_id'] for _ in aln]
-			counts = [len(unique_alns[_]) for _ in species_ids]
-			if sum(counts) == 0:
-				species_id = random.sample(species_ids, 1)[0]
-			else:
-				probs = [float(count)/sum(counts) for count in counts]
-				species_id = np.random.choice(species_ids, 1, p=probs)[0]
-			total_alns[species_id].append(aln[species_ids.index(species_id)])
-	return total_alns
-
-def get_markers(args):
-	""" Read in optimal mapping parameters for marker genes; override if user has provided cutoff """
-	marker_cutoffs = {}
-	inpath = '/'.join([args['db'], 'marker_genes/phyeco.mapping_cutoffs'])
-	if not os.path.isfile(inpath): sys.exit("File not found: %s" % inpath)
-	for line in open(inpath):
-		marker_id, min_pid = line.rstrip().split()
-		if args['mapid']:
-			marker_cutoffs[marker_id] = args['mapid']
-		else:
-			marker_cutoffs[marker_id] = float(min_pid)
-	return marker_cutoffs
-
-def read_gene_lengths(args, species_info, marker_info):
-	""" Read in total gene length per species_id """
-	total_gene_length = dict([(_,0) for _ in species_info])
-	for r in marker_info.values():
-		total_gene_length[r['species_id']] += int(r['gene_length'])
-	return total_gene_length
-
-def normalize_counts(species_alns, total_gene_length):
-	""" Normalize counts by gene length and sum contrain """
 	# norm by gene length, compute cov
-	species_abundance = {}
-	total_cov = 0.0
-	for species_id, alns in species_alns.items():
-		species_abundance[species_id] = {}
-		# compute coverage
-		if len(alns) > 0:
-			bp = sum([aln['aln'] for aln in alns])
-			cov = float(bp)/total_gene_length[species_id]
-		else:
-			cov = 0.0
-		# store results
-		species_abundance[species_id] = {'cov':cov, 'count':len(alns)}
-		total_cov += cov
+	cov = np.zeros(len(total_gene_length))
+	mapped = species_counts['count'] > 0
+	cov[mapped] = species_counts['bp'][mapped]/total_gene_length[mapped].astype(float)
 	# compute relative abundance
-	total_cov = sum([_['cov'] for _ in species_abundance.values()])
-	for species_id in species_abundance.keys():
-		cov = species_abundance[species_id]['cov']
-		species_abundance[species_id]['rel_abun'] = cov/total_cov if total_cov > 0 else 0
-	print("  total marker-gene coverage: %s" % round(total_cov, 3))
-	return species_abundance
-
-def write_abundance(outdir, species_abundance, annotations):
+	total_cov = cov.sum()
+	rel_abun = cov/total_cov if total_cov > 0 else np.zeros(len(cov))
+	if verbose: print("  total marker-gene coverage: %s" % round(total_cov, 3))
+	return {'count':species_counts['count'], 'cov':cov, 'rel_abun':rel_abun}
+
+def write_abundance(outdir, species_abundance, species_ids):
 	""" Write species results to specified output file """
 	outpath = '%s/species/species_profile.txt' % outdir
 	outfile = open(outpath, 'w')
 	fields = ['species_id', 'count_reads', 'coverage', 'relative_abundance']
 	outfile.write('\t'.join(fields)+'\n')
-	species_ids =  sorted([(x, y['count']) for x, y in species_abundance.items()], key=itemgetter(1), reverse=True)
-	for species_id, count_reads in species_ids:
-		values = species_abundance[species_id]
-		record = [species_id, values['count'], values['cov'], values['rel_abun']]
+	counts = species_abundance['count'].tolist()
+	covs = species_abundance['cov'].tolist()
+	rel_abuns = species_abundance['rel_abun'].tolist()
+	for code in sorted(range(len(species_ids)), key=lambda i: counts[i], reverse=True):
+		record = [species_ids[code], counts[code], covs[code], rel_abuns[code]]
 		outfile.write('\t'.join([str(x) for x in record])+'\n')
 
 def read_abundance(inpath):
@@ -223,28 +404,108 @@ def select_species(args):
 		sys.exit("\nError: no species sastisfied your selection criteria. \n")
 	return my_species
 
-def run_pipeline(args):
-	
-	""" Run entire pipeline """
-	# read info files
-	species_info = read_annotations(args)
-	marker_info = read_marker_info(args)
-		
-	# align reads
+def read_cohort(args):
+	""" Read samples from cohort file and create their output directories
+		File is tab-delimited with header fields: sample_id, m1, and optionally m2 """
+	samples = []
+	for r in utility.parse_file(args['cohort']):
+		sample = {'sample_id':r['sample_id'], 'm1':r['m1'], 'm2':r['m2'] if r.get('m2') else None}
+		sample['outdir'] = '%s/%s' % (args['outdir'], sample['sample_id'])
+		if not os.path.isdir('%s/species/temp' % sample['outdir']):
+			os.makedirs('%s/species/temp' % sample['outdir'])
+		samples.append(sample)
+	return samples
+
+def run_cohort(args, index=None):
+	""" Align reads from all samples of cohort with one hs-blastn process and write a profile per sample """
+	if index is None: index = marker_index.MarkerIndex(args['db'])
+	samples = read_cohort(args)
+
+	# align reads from all samples and demultiplex best hits
 	start = time()
-	print("\nAligning reads to marker-genes database")
-	args['log'].write("\nAligning reads to marker-genes database\n")
-	map_reads_hsblast(args)
+	print("\nAligning reads from %s samples to marker-genes database and classifying reads" % len(samples))
+	args['log'].write("\nAligning reads from %s samples to marker-genes database and classifying reads\n" % len(samples))
+	process, command = map_reads_hsblast(args, samples)
+	chunks = parse_blast_chunks(stream_alignments(args, process), index)
+	best_hits = find_best_hits(args, index, chunks)
+	assign_unique_cohort(args, best_hits, index, samples)
+	utility.check_stream_exit_code(process, command, '%s/species/temp/hs-blastn.err' % args['outdir'])
+	if args['dedup'] or args['readq'] is not None or args['dust'] is not None:
+		for sample in samples:
+			utility.log_read_counts(args, '%s/species/temp/read_count.txt' % sample['outdir'])
 	print("  %s minutes" % round((time() - start)/60, 2))
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
 
-	# find best hit for each read
+	# estimate species abundance per sample
 	start = time()
-	print("\nClassifying reads")
-	args['log'].write("\nClassifying reads\n")
-	best_hits = find_best_hits(args, marker_info)
-	unique_alns = assign_unique(args, best_hits, species_info, marker_info)
-	species_alns = assign_non_unique(args, best_hits, unique_alns, marker_info)
+	print("\nEstimating species abundance")
+	args['log'].write("\nEstimating species abundance\n")
+	for sample in samples:
+		species_counts = assign_non_unique(args, sample['non_unique'], sample['unique_counts'])
+		species_abundance = normalize_counts(species_counts, index.species_length, verbose=False)
+		write_abundance(sample['outdir'], species_abundance, index.species_ids)
+		if args['remove_temp']:
+			import shutil
+			shutil.rmtree('%s/species/temp' % sample['outdir'])
+	print("  %s minutes" % round((time() - start)/60, 2) )
+	print("  %s Gb maximum memory" % utility.max_mem_usage())
+
+	# clean up
+	if args['remove_temp']:
+		import shutil
+		shutil.rmtree('%s/species/temp' % args['outdir'])
+
+def run_pipeline(args, index=None, kmer_index=None):
+	
+	""" Run entire pipeline
+		Indexes already loaded by a long-running process (see species_server) can be passed in """
+	if args['cohort']:
+		return run_cohort(args, index)
+
+	# load marker index
+	if index is None: index = marker_index.MarkerIndex(args['db'])
+
+	if args['reclassify']:
+		# find best hit for each read from alignments stored by previous run
+		start = time()
+		print("\nReclassifying reads from stored alignments")
+		args['log'].write("\nReclassifying reads from stored alignments\n")
+		best_hits = find_best_hits(args, index, read_store(args, index))
+		unique_counts, non_unique = assign_unique(args, best_hits, index)
+	elif args['mode'] == 'kmer':
+		# classify reads by species-unique k-mers of marker genes as reads are streamed
+		start = time()
+		print("\nClassifying reads by marker-gene k-mers")
+		args['log'].write("\nClassifying reads by marker-gene k-mers\n")
+		if kmer_index is None: kmer_index = kmers.KmerIndex(args['db'], index)
+		process, command = stream_reads(args)
+		best_hits = kmers.classify_reads(args, kmer_index, index, kmers.stream_reads(process))
+		convergence = Convergence(args) if args['converge'] else None
+		unique_counts, non_unique = assign_unique(args, best_hits, index, convergence)
+		if convergence and convergence.converged:
+			best_hits.close()
+			stop_stream(process)
+		else:
+			utility.check_stream_exit_code(process, command, '%s/species/temp/stream_seqs.err' % args['outdir'])
+	else:
+		# align reads and find best hit for each read as alignments are streamed
+		start = time()
+		print("\nAligning reads to marker-genes database and classifying reads")
+		args['log'].write("\nAligning reads to marker-genes database and classifying reads\n")
+		process, command = map_reads_hsblast(args)
+		chunks = parse_blast_chunks(stream_alignments(args, process), index)
+		if args['keep_alignments']: chunks = write_store(args, index, chunks)
+		best_hits = find_best_hits(args, index, chunks)
+		convergence = Convergence(args) if args['converge'] else None
+		unique_counts, non_unique = assign_unique(args, best_hits, index, convergence)
+		if convergence and convergence.converged:
+			best_hits.close()
+			stop_stream(process)
+		else:
+			utility.check_stream_exit_code(process, command, '%s/species/temp/hs-blastn.err' % args['outdir'])
+	if (args['dedup'] or args['readq'] is not None or args['dust'] is not None) and not args['reclassify']:
+		utility.log_read_counts(args, '%s/species/temp/read_count.txt' % args['outdir'])
+	species_counts = assign_non_unique(args, non_unique, unique_counts)
 	print("  %s minutes" % round((time() - start)/60, 2))
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
 	
@@ -252,13 +513,12 @@ def run_pipeline(args):
 	start = time()
 	print("\nEstimating species abundance")
 	args['log'].write("\nEstimating species abundance\n")
-	total_gene_length = read_gene_lengths(args, species_info, marker_info)
-	species_abundance = normalize_counts(species_alns, total_gene_length)
+	species_abundance = normalize_counts(species_counts, index.species_length)
 	print("  %s minutes" % round((time() - start)/60, 2) )
 	print("  %s Gb maximum memory" % utility.max_mem_usage())
 	
 	# write results
-	write_abundance(args['outdir'], species_abundance, species_info)
+	write_abundance(args['outdir'], species_abundance, index.species_ids)
 
 	# clean up
 	if args['remove_temp']:
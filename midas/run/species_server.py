@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import sys, os, json, socket, threading, traceback
+from time import time
+from midas.run import marker_index, kmers
+try: import socketserver
+except ImportError: import SocketServer as socketserver # python2
+
+def send_message(sock, message):
+	""" Send message to socket as one line of JSON """
+	sock.sendall((json.dumps(message)+'\n').encode())
+
+def recv_message(sock):
+	""" Read one line of JSON from socket """
+	data = b''
+	while not data.endswith(b'\n'):
+		block = sock.recv(65536)
+		if not block: break
+		data += block
+	if not data:
+		return None
+	return json.loads(data.decode())
+
+def submit_job(socket_path, argv, cwd=None):
+	""" Submit 'run_midas.py species' arguments to running species server and wait for reply """
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+	except socket.error as e:
+		sys.exit("\nError: Could not connect to species server at %s: %s" % (socket_path, e))
+	try:
+		send_message(sock, {'cwd':cwd or os.getcwd(), 'argv':argv})
+		reply = recv_message(sock)
+	finally:
+		sock.close()
+	if reply is None:
+		sys.exit("\nError: Species server closed connection without reply")
+	return reply
+
+class ThreadBudget:
+	""" Limit the total number of threads used by concurrent jobs """
+	def __init__(self, threads):
+		self.threads = threads
+		self.available = threads
+		self.condition = threading.Condition()
+
+	def acquire(self, n):
+		""" Wait until n threads are available and reserve them; returns number reserved """
+		n = max(1, min(n, self.threads))
+		with self.condition:
+			while self.available < n:
+				self.condition.wait()
+			self.available -= n
+		return n
+
+	def release(self, n):
+		with self.condition:
+			self.available += n
+			self.condition.notify_all()
+
+class JobHandler(socketserver.StreamRequestHandler):
+	""" Run one job per connection and reply with its status """
+	def handle(self):
+		start = time()
+		try:
+			job = recv_message(self.request)
+			if job is None: return
+			reply = {'status':'ok', 'profile':self.server.run_job(job, self.server)}
+		except SystemExit as e: # argument and pipeline errors
+			reply = {'status':'error', 'message':str(e.code).strip()}
+		except Exception:
+			reply = {'status':'error', 'message':traceback.format_exc()}
+		reply['seconds'] = round(time() - start, 2)
+		send_message(self.request, reply)
+
+class SpeciesServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	""" Serve species profiling jobs over a Unix socket with the marker database loaded once
+		Each job is run by run_job(job, server) in its own thread """
+	daemon_threads = True
+
+	def __init__(self, socket_path, db, threads, run_job):
+		self.socket_path = socket_path
+		self.db = db
+		self.run_job = run_job
+		self.budget = ThreadBudget(threads)
+		self.index = marker_index.MarkerIndex(db)
+		self.lock = threading.Lock()
+		self._kmer_index = None
+		remove_stale_socket(socket_path)
+		socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+	def kmer_index(self):
+		""" K-mer index is loaded (or built) by the first job using --mode kmer """
+		with self.lock:
+			if self._kmer_index is None:
+				self._kmer_index = kmers.KmerIndex(self.db, self.index)
+		return self._kmer_index
+
+	def serve(self):
+		""" Serve jobs until interrupted or terminated, then remove socket """
+		import signal
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+		try:
+			self.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.server_close()
+			if os.path.exists(self.socket_path): os.remove(self.socket_path)
+
+def remove_stale_socket(socket_path):
+	""" Remove socket left by a server that is no longer running """
+	if not os.path.exists(socket_path):
+		return
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_path)
+	except socket.error:
+		os.remove(socket_path)
+		return
+	finally:
+		sock.close()
+	sys.exit("\nError: Species server already running at %s" % socket_path)
@@ -4,8 +4,14 @@
 # Copyright (C) 2015 Stephen Nayfach
 # Freely distributed under the GNU General Public License (GPLv3)
 
-import sys, argparse
+import sys, os, io, argparse, math, random, threading, zlib, itertools, signal, errno
+import numpy as np
+from operator import itemgetter
 from midas import utility
+try: from itertools import izip as zip # python2
+except ImportError: pass
+try: import queue
+except ImportError: import Queue as queue # python2
 
 def readfq(fp):
 	""" https://github.com/lh3/readfq/blob/master/readfq.py 
@@ -40,28 +46,388 @@ def readfq(fp):
 				yield name, seq, None # yield a fasta record instead
 				break
 
+def parse_fastq(data, eof):
+	""" Parse complete 4-line FASTQ records from start of data; returns (names, seqs, quals) and unparsed data
+		Returns None if records are not 4 lines each (e.g. wrapped sequences), so readfq_batches is used instead """
+	lines = data.split(b'\n')
+	if eof:
+		while lines and not lines[-1]: lines.pop()
+		n = len(lines)
+		if n % 4: return None
+	else:
+		n = (len(lines) - 1)//4*4
+	headers, seqs, plus, quals = lines[0:n:4], lines[1:n:4], lines[2:n:4], lines[3:n:4]
+	if (any([_[:1] != b'@' for _ in headers]) or any([_[:1] != b'+' for _ in plus])
+			or any([len(_) != len(q) for _, q in zip(seqs, quals)])):
+		return None
+	names = [_[1:].partition(b' ')[0] for _ in headers]
+	return (names, seqs, quals), b'\n'.join(lines[n:])
+
+def readfq_batches(data, infile, batch_size=100000):
+	""" Yield batches of records parsed by readfq from data followed by the rest of infile
+		Slower than parse_fastq, but also reads FASTQ with wrapped sequence and quality lines """
+	data += infile.readline() # complete last line of data
+	lines = (_.decode() if _[-1:] == b'\n' else _.decode()+'\n' for _ in itertools.chain(io.BytesIO(data), infile))
+	batch = ([], [], [])
+	for name, seq, qual in readfq(lines):
+		if qual is None:
+			sys.exit("\nError: Truncated FASTQ record at end of file")
+		for values, value in zip(batch, [name, seq, qual]): values.append(value.encode())
+		if len(batch[0]) == batch_size:
+			yield batch
+			batch = ([], [], [])
+	if batch[0]: yield batch
+
+def parse_fasta(data, eof):
+	""" Parse complete FASTA records from start of data; returns (names, seqs, None) and unparsed data """
+	end = len(data) if eof else data.rfind(b'\n>') + 1 # last record may continue in next block
+	names, seqs = [], []
+	if end > 0:
+		for record in data[1:end].split(b'\n>'):
+			header, newline, seq = record.partition(b'\n')
+			names.append(header.partition(b' ')[0])
+			seqs.append(seq.replace(b'\n', b''))
+	return (names, seqs, None), data[end:]
+
+def parse_batches(inpath, block_size=2**22):
+	""" Yield batches of records parsed from large decompressed blocks of a FASTA/FASTQ file
+		Each batch is a tuple of lists of bytes: (names, seqs, quals); quals is None for FASTA """
+	infile = utility.bopen(inpath)
+	data = b''
+	eof = False
+	while not eof:
+		block = infile.read(block_size)
+		eof = not block
+		data = (data + block).lstrip() if not data else data + block
+		if not data: break
+		if data[:1] == b'@':
+			parsed = parse_fastq(data, eof)
+			if parsed is None: # not 4-line records
+				for batch in readfq_batches(data, infile): yield batch
+				break
+			batch, data = parsed
+		elif data[:1] == b'>': batch, data = parse_fasta(data, eof)
+		else: sys.exit("\nError: Filetype [fasta, fastq] of %s could not be recognized" % inpath)
+		if batch[0]: yield batch
+	infile.close()
+
+def prefetch(batches, size=4):
+	""" Produce batches in a background thread, so that decompressing and parsing each mate file
+		runs concurrently with the other mate file and with writing output """
+	q = queue.Queue(size)
+	def produce():
+		try:
+			for batch in batches: q.put((True, batch))
+			q.put((False, None))
+		except BaseException as e: # pass errors, including sys.exit, to consumer
+			q.put((False, e))
+	thread = threading.Thread(target=produce)
+	thread.daemon = True # do not wait for thread if consumer stops early
+	thread.start()
+	while True:
+		ok, batch = q.get()
+		if ok: yield batch
+		elif batch is None: return
+		else: raise batch
+
+def trim_batch(args, batch):
+	""" Trim reads to -l and drop reads shorter than -l """
+	if not args['read_length']:
+		return batch
+	length = args['read_length']
+	names, seqs, quals = batch
+	keep = [i for i, seq in enumerate(seqs) if len(seq) >= length]
+	return ([names[i] for i in keep], [seqs[i][:length] for i in keep],
+			[quals[i][:length] for i in keep] if quals is not None else None)
+
+# 2-bit code of each byte; 4 marks bases other than A, C, G, T
+base_codes = np.repeat(np.uint8(4), 256)
+for code, base in enumerate('ACGT'):
+	base_codes[ord(base)] = code
+	base_codes[ord(base.lower())] = code
+
+def dust_scores(seqs):
+	""" DUST-like low-complexity score of each read: percent of pairs of triplets in read that are identical
+		100 for homopolymers, 50 for dinucleotide repeats, and about 2 for random sequence """
+	lengths = np.array([len(_) for _ in seqs], dtype=np.int64)
+	codes = base_codes[np.frombuffer(b''.join(seqs), dtype=np.uint8)].astype(np.int64)
+	n = len(codes) - 2
+	if n <= 0: return np.zeros(len(seqs))
+	read_index = np.repeat(np.arange(len(seqs)), lengths)
+	valid = (read_index[:n] == read_index[2:]) & (codes[:n] < 4) & (codes[1:n+1] < 4) & (codes[2:] < 4)
+	triplets = 16*codes[:n] + 4*codes[1:n+1] + codes[2:]
+	counts = np.bincount(64*read_index[:n][valid] + triplets[valid], minlength=64*len(seqs)).reshape(-1, 64)
+	total = counts.sum(axis=1)
+	pairs = (counts*(counts-1)//2).sum(axis=1)
+	return 100.0*pairs/np.maximum(total*(total-1)//2, 1)
+
+def mean_qualities(quals):
+	""" Mean phred quality score of each read (phred+33) """
+	lengths = np.array([len(_) for _ in quals], dtype=np.int64)
+	sums = np.concatenate([[0], np.cumsum(np.frombuffer(b''.join(quals), dtype=np.uint8).astype(np.int64) - 33)])
+	ends = np.cumsum(lengths)
+	return (sums[ends] - sums[ends - lengths])/np.maximum(lengths, 1).astype(float)
+
+def filter_mask(args, seqs, quals, counts):
+	""" Mask of reads with mean quality >= -q and DUST score <= -c; seqs is None for reads already dropped """
+	keep = np.array([_ is not None for _ in seqs], dtype=bool)
+	present = np.flatnonzero(keep)
+	if args['min_quality'] is not None and quals is not None and len(present) and quals[present[0]] is not None:
+		low = mean_qualities([quals[i] for i in present]) < args['min_quality']
+		counts['low_quality'] += int(low.sum())
+		keep[present[low]] = False
+		present = present[~low]
+	if args['max_dust'] is not None and len(present):
+		low = dust_scores([seqs[i] for i in present]) > args['max_dust']
+		counts['low_complexity'] += int(low.sum())
+		keep[present[low]] = False
+	return keep
+
+def filter_batch(args, batch, counts):
+	""" Drop reads failing -q or -c filters from batch """
+	if args['min_quality'] is None and args['max_dust'] is None:
+		return batch
+	names, seqs, quals = batch
+	keep = np.flatnonzero(filter_mask(args, seqs, quals, counts))
+	return ([names[i] for i in keep], [seqs[i] for i in keep], [quals[i] for i in keep] if quals is not None else None)
+
+def head_batches(args, counts):
+	""" Yield batches of the first -n reads, reading mates from -2 after all reads from -1 """
+	reads = 0
+	sources = [prefetch(parse_batches(_)) for _ in args['input']]
+	for batches in sources:
+		for batch in batches:
+			batch = filter_batch(args, trim_batch(args, batch), counts)
+			if reads + len(batch[1]) >= args['max_reads']:
+				n = int(args['max_reads'] - reads)
+				yield tuple([_[:n] if _ is not None else None for _ in batch])
+				return
+			reads += len(batch[1])
+			yield batch
+
+def read_records(args, inpath, counts):
+	""" Yield (name, seq, qual) of each read in file after trimming
+		seq is None for reads shorter than -l or failing -q or -c filters """
+	length = args['read_length']
+	for names, seqs, quals in prefetch(parse_batches(inpath)):
+		if quals is None: quals = [None] * len(seqs)
+		if length:
+			seqs = [seq[:length] if len(seq) >= length else None for seq in seqs]
+			quals = [qual[:length] if qual else qual for qual in quals]
+		keep = filter_mask(args, seqs, quals, counts)
+		for name, seq, qual, passed in zip(names, seqs, quals, keep):
+			yield (name, seq, qual) if passed else (name, None, None)
+
+def read_units(args, counts):
+	""" Yield reads to sample as a unit: a tuple with 1 read, or with both mates if -2 is given
+		Mates dropped by -l, -q, or -c are removed from their unit """
+	for records in zip(*[read_records(args, _, counts) for _ in args['input']]):
+		unit = tuple([_ for _ in records if _[1] is not None])
+		if unit: yield unit
+
+def random_open(rng):
+	""" Uniform random number in (0, 1) """
+	u = rng.random()
+	while u == 0.0: u = rng.random()
+	return u
+
+def sample_fraction(units, fraction, rng):
+	""" Keep each unit with probability FRACTION
+		Draws the geometric gap to the next kept unit instead of a random number per unit """
+	if fraction >= 1.0:
+		for unit in units: yield unit
+		return
+	log_q = math.log(1.0 - fraction)
+	skip = int(math.log(random_open(rng)) / log_q)
+	for unit in units:
+		if skip == 0:
+			yield unit
+			skip = int(math.log(random_open(rng)) / log_q)
+		else:
+			skip -= 1
+
+def sample_reservoir(units, size, rng):
+	""" Uniform sample of exactly SIZE units (or all if fewer) in one pass, returned in input order
+		Reservoir sampling with Li's algorithm L, which draws random numbers only for units that are kept """
+	def next_skip(w):
+		if w >= 1.0: return 0
+		return int(math.log(random_open(rng)) / math.log(1.0 - w))
+	reservoir = []
+	w, next_index = 1.0, size
+	for index, unit in enumerate(units):
+		if index < size:
+			reservoir.append((index, unit))
+			if index == size - 1:
+				w = math.exp(math.log(random_open(rng))/size)
+				next_index = index + next_skip(w) + 1
+		elif index == next_index:
+			reservoir[rng.randrange(size)] = (index, unit)
+			w *= math.exp(math.log(random_open(rng))/size)
+			next_index = index + next_skip(w) + 1
+	return [unit for index, unit in sorted(reservoir, key=itemgetter(0))]
+
+class BloomFilter:
+	""" Fixed-size bit array recording hashed reads; memory does not grow with the number of reads
+		False positives make a small fraction of distinct reads look like duplicates """
+	def __init__(self, megabytes, hashes=4):
+		self.bits = np.zeros(int(megabytes*2**20), dtype=np.uint8)
+		self.size = np.uint64(8*len(self.bits))
+		self.hashes = hashes
+
+	def add(self, h1, h2):
+		""" Add items given by two arrays of 32-bit hashes; returns mask of items that were possibly added before """
+		seen = np.ones(len(h1), dtype=bool)
+		positions = []
+		for i in range(self.hashes): # double hashing
+			pos = (h1 + np.uint64(i)*h2) % self.size
+			seen &= ((self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1) == 1
+			positions.append(pos)
+		for pos in positions:
+			np.bitwise_or.at(self.bits, pos >> np.uint64(3), np.left_shift(1, pos & np.uint64(7)).astype(np.uint8))
+		return seen
+
+def dedup_units(units, bloom, counts, size=2**16):
+	""" Drop units whose sequences (both mates if paired) exactly repeat an earlier unit """
+	while True:
+		chunk = list(itertools.islice(units, size))
+		if not chunk: break
+		seqs = [b'\n'.join([_[1] for _ in unit]) for unit in chunk]
+		h1 = np.array([zlib.crc32(_) & 0xffffffff for _ in seqs], dtype=np.uint64)
+		h2 = np.array([zlib.adler32(_) & 0xffffffff for _ in seqs], dtype=np.uint64) | np.uint64(1)
+		# first copy of each unit within chunk, then units not seen in earlier chunks
+		first = np.sort(np.unique((h1 << np.uint64(32)) | h2, return_index=True)[1])
+		keep = first[~bloom.add(h1[first], h2[first])]
+		counts['duplicates'] += sum([len(_) for _ in chunk]) - sum([len(chunk[i]) for i in keep])
+		for i in keep: yield chunk[i]
+
+def head_units(units, max_reads):
+	""" Yield units until -n reads have been yielded, counting reads as head_batches does
+		A pair that would exceed -n is cut to its first mate """
+	reads = 0
+	for unit in units:
+		if reads + len(unit) >= max_reads:
+			unit = unit[:int(max_reads - reads)]
+			if unit: yield unit
+			return
+		reads += len(unit)
+		yield unit
+
+def fasta_records(prefix, names, seqs):
+	""" Format reads as FASTA named by read name and length, as aligned by hs-blastn """
+	return b''.join([b'>%s%s_%d\n%s\n' % (prefix, name, len(seq), seq) for name, seq in zip(names, seqs)])
+
+def original_records(records):
+	""" Format (name, seq, qual) reads as FASTQ, or as FASTA if there are no quality scores """
+	if records and records[0][2] is None:
+		return b''.join([b'>%s\n%s\n' % (name, seq) for name, seq, qual in records])
+	return b''.join([b'@%s\n%s\n+\n%s\n' % record for record in records])
+
+class BatchWriter:
+	""" Write to file from a background thread
+		Outputs read in lockstep (i.e. mate files read by bowtie2 through named pipes) cannot block each other """
+	def __init__(self, path):
+		self.path = path
+		self.queue = queue.Queue(4)
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		outfile = open(self.path, 'wb') # blocks until named pipe is opened by reader
+		while True:
+			data = self.queue.get()
+			if data is None: break
+			if outfile is None: continue # reader has stopped; discard remaining data
+			try:
+				outfile.write(data)
+			except IOError: # i.e. bowtie2 -u stops reading early
+				outfile = None
+		if outfile is not None:
+			try: outfile.close()
+			except IOError: pass
+
+	def write(self, data):
+		self.queue.put(data)
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+def write_units(args, counts):
+	""" Read units of 1 read or both mates, remove duplicates, subsample, and write
+		Reads are written as renamed FASTA to stdout, or in their original format to --out1 (and --out2) """
+	rng = random.Random(args['seed'])
+	units = read_units(args, counts)
+	if args['dedup_mem']:
+		units = dedup_units(units, BloomFilter(args['dedup_mem']), counts)
+	if args['fraction'] is not None:
+		units = sample_fraction(units, args['fraction'], rng)
+	elif args['sample_reads'] is not None:
+		units = sample_reservoir(units, args['sample_reads'], rng)
+	elif args['max_reads'] != float('Inf'):
+		units = head_units(units, args['max_reads'])
+	units = iter(units) # reservoir sample is a list
+	if args['out1']:
+		writers = [BatchWriter(_) for _ in [args['out1'], args['out2']] if _]
+	else:
+		outfile = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout # python2 stdout takes bytes
+		prefix = args['prefix'].encode()
+	while True:
+		chunk = list(itertools.islice(units, 2**16))
+		if not chunk: break
+		if args['out1']:
+			chunk = [_ for _ in chunk if len(_) == len(writers)] # mates must stay in sync
+			for mate, writer in enumerate(writers):
+				writer.write(original_records([unit[mate] for unit in chunk]))
+		else:
+			records = [record for unit in chunk for record in unit]
+			outfile.write(fasta_records(prefix, [_[0] for _ in records], [_[1] for _ in records]))
+		counts['reads'] += sum([len(_) for _ in chunk])
+		counts['bp'] += sum([len(record[1]) for unit in chunk for record in unit])
+	if args['out1']:
+		for writer in writers: writer.close()
+	else:
+		outfile.flush()
+
+def write_batches(args, counts):
+	""" Write the first -n reads as renamed FASTA to stdout """
+	outfile = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout # python2 stdout takes bytes
+	prefix = args['prefix'].encode()
+	for names, seqs, quals in head_batches(args, counts):
+		outfile.write(fasta_records(prefix, names, seqs))
+		counts['reads'] += len(seqs)
+		counts['bp'] += sum([len(_) for _ in seqs])
+	outfile.flush()
+
+count_fields = ['reads', 'bp', 'duplicates', 'low_quality', 'low_complexity']
+
+class StreamStopped(Exception):
+	""" Raised on SIGTERM, i.e. when run_midas.py species stops reading once abundances have converged """
+
+def stop_stream(signum, frame):
+	raise StreamStopped()
+
+def write_counts(counts):
+	""" Write number of reads and bp written, and of reads removed by filters, to stderr """
+	sys.stderr.write('\t'.join(count_fields)+'\n'+'\t'.join([str(counts[_]) for _ in count_fields])+'\n')
+	sys.stderr.flush()
+
 def main():
 	""" Run main pipeline """
 	args = parse_args()
-	reads = 0
-	bp = 0
-	for inpath in args['input']:
-		infile = utility.iopen(inpath)
-		for name, seq, qual in readfq(infile):
-			seq_len = len(seq)
-			if args['read_length']: # trim/filter reads
-				if seq_len < args['read_length']:
-					continue
-				else:
-					seq = seq[0:args['read_length']]
-					seq_len = len(seq)
-			sys.stdout.write('>%s_%s\n%s\n' % (name, seq_len, seq))
-			reads += 1
-			bp += seq_len
-			if reads == args['max_reads']:
-				sys.stderr.write('%s\t%s' % (reads, bp)) # write number of reads, bp to stderr
-				return
-	sys.stderr.write('%s\t%s' % (reads, bp)) # write number of reads, bp to stderr
+	counts = dict([(_, 0) for _ in count_fields])
+	signal.signal(signal.SIGTERM, stop_stream)
+	try:
+		if any([args['fraction'] is not None, args['sample_reads'] is not None, args['dedup_mem'], args['out1']]):
+			write_units(args, counts)
+		else:
+			write_batches(args, counts) # fastest; mates are not read together
+	except (StreamStopped, IOError) as error:
+		if isinstance(error, IOError) and error.errno != errno.EPIPE: raise
+		# stopped early or reader closed stdout: keep counts of reads processed so far
+		write_counts(counts)
+		os._exit(1) # skip flushing closed stdout and waiting for reader threads
+	write_counts(counts)
 
 def parse_args():
 	parser = argparse.ArgumentParser()
@@ -69,7 +435,17 @@ def parse_args():
 	parser.add_argument('-2', type=str, dest='m2')
 	parser.add_argument('-l', type=int, dest='read_length')
 	parser.add_argument('-n', type=int, dest='max_reads', default=float('Inf'))
+	parser.add_argument('-f', type=float, dest='fraction') # uniformly sample fraction of reads (or pairs)
+	parser.add_argument('-r', type=int, dest='sample_reads') # uniformly sample exactly this many reads (or pairs)
+	parser.add_argument('-s', type=int, dest='seed', default=1) # seed for sampling
+	parser.add_argument('-d', type=float, dest='dedup_mem') # remove duplicate reads (or pairs) with bloom filter of this many MB
+	parser.add_argument('-q', type=float, dest='min_quality') # remove reads with mean quality below this
+	parser.add_argument('-c', type=float, dest='max_dust') # remove reads with DUST score above this (0-100)
+	parser.add_argument('--out1', type=str) # write reads in original format to file (i.e. named pipe read by bowtie2)
+	parser.add_argument('--out2', type=str) # write mates in original format to file
+	parser.add_argument('-t', type=str, dest='tag') # tag read names with sample
 	args = vars(parser.parse_args())
+	args['prefix'] = '%s|' % args['tag'] if args['tag'] is not None else ''
 	args['input'] = [args['m1']]
 	if args['m2']: args['input'].append(args['m2'])
 	return args
@@ -84,11 +84,12 @@ def add_executables(args):
 	main_dir = os.path.dirname(src_dir)
 	args['stream_bam'] = '/'.join([src_dir, 'run', 'stream_bam.py'])
 	args['stream_seqs'] = '/'.join([src_dir, 'run', 'stream_seqs.py'])
+	args['filter_sam'] = '/'.join([src_dir, 'run', 'filter_sam.py'])
 	args['hs-blastn'] = '/'.join([main_dir, 'bin', platform.system(), 'hs-blastn'])
 	args['bowtie2-build'] = '/'.join([main_dir, 'bin', platform.system(), 'bowtie2-build'])
 	args['bowtie2'] = '/'.join([main_dir, 'bin', platform.system(), 'bowtie2'])
 	args['samtools'] = '/'.join([main_dir, 'bin', platform.system(), 'samtools'])
-	for arg in ['hs-blastn', 'stream_seqs', 'bowtie2-build', 'bowtie2', 'samtools', 'stream_bam']:
+	for arg in ['hs-blastn', 'stream_seqs', 'bowtie2-build', 'bowtie2', 'samtools', 'stream_bam', 'filter_sam']:
 		if not os.path.isfile(args[arg]):
 			sys.exit("File not found: %s" % args[arg])
 	for arg in ['hs-blastn', 'bowtie2-build', 'bowtie2', 'samtools']:
@@ -156,6 +157,13 @@ def iopen(inpath, mode='r'):
 		elif ext == 'bz2': return bz2.BZ2File(inpath, mode)
 		else: return open(inpath, mode)
 
+def bopen(inpath):
+	""" Open input file for reading bytes regardless of compression [gzip, bzip] """
+	ext = inpath.split('.')[-1]
+	if ext == 'gz': return gzip.open(inpath, 'rb')
+	elif ext == 'bz2': return bz2.BZ2File(inpath, 'rb')
+	else: return open(inpath, 'rb')
+
 def parse_file(inpath):
 	""" Yields records from tab-delimited file with header """
 	infile = iopen(inpath)
@@ -182,6 +190,78 @@ def check_exit_code(process, command):
 		err_message = "\nError encountered executing:\n%s\n\nError message:\n%s" % (command, err)
 		sys.exit(err_message)
 
+def check_stream_exit_code(process, command, errpath):
+	""" Wait for process whose stdout has been consumed. Check unix exit code and exit if non-zero """
+	process.wait()
+	if process.returncode != 0:
+		err = open(errpath).read()
+		err_message = "\nError encountered executing:\n%s\n\nError message:\n%s" % (command, err)
+		sys.exit(err_message)
+
+def prefilter_reads(args):
+	""" Check if reads are filtered by stream_seqs before alignment with bowtie2 """
+	return args['dedup'] or args['dust'] is not None or args['prefilter']
+
+def stream_filtered_reads(args, program):
+	""" Start stream_seqs to remove duplicate, low-quality, and low-complexity reads, writing reads to named pipes in temp directory
+		Returns the running process and paths to pass to bowtie2 in place of m1 and m2 """
+	tempdir = '%s/%s/temp' % (args['outdir'], program)
+	paths = ['%s/reads_1.fifo' % tempdir, '%s/reads_2.fifo' % tempdir if args['m2'] else None]
+	for path in paths:
+		if path is None: continue
+		if os.path.exists(path): os.remove(path)
+		os.mkfifo(path)
+	command = 'python %s -1 %s' % (args['stream_seqs'], args['m1'])
+	if args['m2']: command += ' -2 %s' % args['m2']
+	if args['dedup']: command += ' -d %s' % args['dedup_mem'] # duplicates
+	if args['prefilter']: command += ' -q %s' % args['readq'] # mean quality
+	if args['dust'] is not None: command += ' -c %s' % args['dust'] # low complexity
+	command += ' --out1 %s' % paths[0]
+	if args['m2']: command += ' --out2 %s' % paths[1]
+	command += ' 2> %s/read_count.txt' % tempdir # tmpfile to store # of reads, bp, and reads removed
+	args['log'].write('command: '+command+'\n')
+	process = subprocess.Popen(command, shell=True, start_new_session=True) # own process group so it can be stopped
+	import atexit
+	atexit.register(stop_process_group, process) # i.e. bowtie2 failed before opening named pipes
+	return process, paths
+
+def stop_process_group(process):
+	""" Terminate process started with its own process group if still running """
+	import signal
+	if process.poll() is None:
+		try: os.killpg(process.pid, signal.SIGTERM)
+		except OSError: pass
+		process.wait()
+
+def finish_filtered_reads(args, program, process, paths):
+	""" Wait for stream_seqs after bowtie2 has read all reads, remove named pipes, and log reads removed """
+	process.wait()
+	for path in paths:
+		if path and os.path.exists(path): os.remove(path)
+	log_read_counts(args, '%s/%s/temp/read_count.txt' % (args['outdir'], program))
+
+def read_stream_counts(inpath):
+	""" Read number of reads, bp, and reads removed by each filter written by stream_seqs; returns None if missing """
+	if not os.path.isfile(inpath):
+		return None
+	lines = open(inpath).read().rstrip('\n').split('\n')
+	if len(lines) < 2 or lines[-2].split('\t')[0] != 'reads':
+		return None
+	return dict(zip(lines[-2].split('\t'), [int(_) for _ in lines[-1].split('\t')]))
+
+def log_read_counts(args, inpath):
+	""" Print and log number of reads removed by stream_seqs """
+	counts = read_stream_counts(inpath)
+	if counts is None:
+		message = "  reads removed before alignment: unavailable (no counts in %s)" % inpath
+		print(message)
+		args['log'].write(message.strip()+'\n')
+		return
+	message = "  reads removed before alignment: %s duplicate, %s low quality, %s low complexity (%s reads kept)" % (
+		counts['duplicates'], counts['low_quality'], counts['low_complexity'], counts['reads'])
+	print(message)
+	args['log'].write(message.strip()+'\n')
+
 def check_bamfile(args, bampath):
 	""" Use samtools to check bamfile integrity """
 	command = '%s view %s > /dev/null' % (args['samtools'], bampath)
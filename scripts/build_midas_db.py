@@ -54,6 +54,9 @@ to prevent exceeding USEARCH's 4G memory limit (500)""")
 		help="Maximum number of genomes to process per species (use all).\nUseful for quick tests")
 	parser.add_argument('--compress', action='store_true', default=False,
 		help="Compress output files with gzip")
+	parser.add_argument('--bowtie2_index', action='store_true', default=False,
+		help="""Build bowtie2 databases of all pangenomes and representative genomes
+Used by 'run_midas.py genes/snps --prebuilt' to skip building a database per sample""")
 
 	args = vars(parser.parse_args())
 	
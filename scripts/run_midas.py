@@ -19,8 +19,9 @@ def get_program():
 		print('\tspecies\t estimate the abundance of 5,952 bacterial species')
 		print('\tgenes\t identify gene copy number variants in abundant species')
 		print('\tsnps\t identify single nucleotide variants in abundant species')
+		print('\tspecies_server\t keep the species database loaded and run species jobs submitted over a Unix socket')
 		quit()
-	elif sys.argv[1] not in ['species', 'genes', 'snps']:
+	elif sys.argv[1] not in ['species', 'genes', 'snps', 'species_server']:
 		sys.exit("Error: Unrecognized command: '%s'" % sys.argv[1])
 		quit()
 	else:
@@ -82,7 +83,7 @@ def run_program(program, args):
 	else:
 		sys.exit("Error: Unrecognized program: '%s'" % program)
 
-def species_arguments():
+def species_arguments(argv=None):
 	parser = argparse.ArgumentParser(
 		formatter_class=argparse.RawTextHelpFormatter,
 		usage=argparse.SUPPRESS,
@@ -105,27 +106,74 @@ run_midas.py species /path/to/outdir -1 /path/to/reads_1.fq.gz -t 4 -n 4000000
 3) run with exactly 80 base-pair reads:
 run_midas.py species /path/to/outdir -1 /path/to/reads_1.fq.gz --read_length 80
 
+4) store alignments, then reclassify reads with a stricter alignment coverage:
+run_midas.py species /path/to/outdir -1 /path/to/reads_1.fq.gz --keep_alignments
+run_midas.py species /path/to/outdir --reclassify --aln_cov 0.9
+
+5) profile a cohort of samples listed in samples.txt with a single database search:
+run_midas.py species /path/to/outdir --cohort samples.txt -t 8
+
+6) fast profile without alignment using species-unique k-mers of marker genes:
+run_midas.py species /path/to/outdir -1 /path/to/reads_1.fq.gz --mode kmer
+
 """)
 	parser.add_argument('program', help=argparse.SUPPRESS)
 	parser.add_argument('outdir', type=str,
 		help="""Path to directory to store results.
 Name should correspond to sample identifier.""")
-	parser.add_argument('-1', type=str, dest='m1', required=True,
+	parser.add_argument('-1', type=str, dest='m1',
 		help="""FASTA/FASTQ file containing 1st mate if using paired-end reads.
 Otherwise FASTA/FASTQ containing unpaired reads.
-Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
+Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)
+Required unless using --reclassify or --cohort""")
 	parser.add_argument('-2', type=str, dest='m2',
 		help="""FASTA/FASTQ file containing 2nd mate if using paired-end reads.
 Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 	parser.add_argument('-n', type=int, dest='max_reads',
-		help="""Number of reads to use from input file(s) (use all)""")
+		help="""Number of reads to use from input file(s) (use all)\nReads are taken from the start of the file(s)""")
+	parser.add_argument('--sample_frac', type=float, metavar='FLOAT',
+		help="""Uniformly sample FLOAT fraction of reads from the whole input
+Mates are sampled together""")
+	parser.add_argument('--sample_reads', type=int, metavar='INT',
+		help="""Uniformly sample exactly INT reads (or read pairs) from the whole input
+Sampled reads are held in memory until the input has been read""")
 	parser.add_argument('-t', dest='threads', default=1,
 		help="""Number of threads to use for database search (1)""")
+	parser.add_argument('--dedup', default=False, action='store_true',
+		help="""Remove exact duplicate reads (or read pairs) before database search""")
+	parser.add_argument('--dedup_mem', type=float, metavar='MB', default=256,
+		help="""Memory for detecting duplicates with a Bloom filter (256)
+A small fraction of distinct reads is removed when too little memory is used""")
+	parser.add_argument('--readq', type=int, metavar='INT',
+		help="""Discard reads with mean quality < READQ before database search
+By default, reads are not filtered by quality""")
+	parser.add_argument('--dust', type=float, metavar='FLOAT',
+		help="""Discard low-complexity reads with DUST score > DUST before database search
+Scores range from 0-100 (homopolymers: 100, dinucleotide repeats: 50); ex: 20""")
 	parser.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
 		help="""Path to reference database
 By default, the MIDAS_DB environmental variable is used""")
 	parser.add_argument('--remove_temp', default=False, action='store_true',
 		help="""Remove intermediate files generated by MIDAS.\nUseful to reduce disk space of MIDAS output""")
+	parser.add_argument('--keep_m8', default=False, action='store_true',
+		help="""Write BLAST alignments to temp/alignments.m8.
+By default, alignments are classified as they are streamed from HS-BLASTN""")
+	parser.add_argument('--keep_alignments', default=False, action='store_true',
+		help="""Store alignments in temp/alignments to rerun with --reclassify.
+By default, alignments are not written to disk""")
+	parser.add_argument('--cohort', type=str, metavar='PATH',
+		help="""Profile many samples with a single HS-BLASTN process.
+Tab-delimited file with header fields: sample_id, m1, and (optionally) m2
+Results for each sample are written to OUTDIR/SAMPLE_ID/species""")
+	parser.add_argument('--reclassify', default=False, action='store_true',
+		help="""Reclassify reads from alignments stored by a previous run with --keep_alignments
+Use to apply new --mapid, --aln_cov, or marker cutoffs without realigning reads""")
+	parser.add_argument('--mode', choices=['align', 'kmer'], default='align',
+		help="""Method used to classify reads (align)
+align: align reads to marker genes with HS-BLASTN
+kmer: match exact k-mers unique to one species; faster but less sensitive""")
+	parser.add_argument('--min_kmers', type=int, metavar='INT', default=2,
+		help="""Discard reads sharing < MIN_KMERS k-mers with marker genes (2)\nOnly used with --mode kmer""")
 	parser.add_argument('--word_size', type=int, metavar='INT', default=28,
 		help="""Word size for BLAST search (28)\nUse word sizes > 16 for greatest efficiency.""")
 	parser.add_argument('--mapid', type=float, metavar='FLOAT',
@@ -134,7 +182,17 @@ By default, the MIDAS_DB environmental variable is used""")
 		help="""Discard reads with alignment coverage < ALN_COV (0.75)\nValues between 0-1 accepted""")
 	parser.add_argument('--read_length', type=int, metavar='INT',
 		help="""Trim reads to READ_LENGTH and discard reads with length < READ_LENGTH\nBy default, reads are not trimmed or filtered""")
-	args = vars(parser.parse_args())
+	parser.add_argument('--seed', type=int, metavar='INT', default=1,
+		help="""Seed for subsampling reads and for random assignment of ambiguously mapped reads (1)\nReruns with the same seed give identical results""")
+	parser.add_argument('--converge', type=float, metavar='FLOAT',
+		help="""Stop aligning reads once the relative abundances of the top species
+change by < CONVERGE between successive estimates (ex: 0.005)
+By default, all reads (or -n reads) are used""")
+	parser.add_argument('--converge_topn', type=int, metavar='INT', default=10,
+		help="""Number of most abundant species checked for convergence (10)""")
+	parser.add_argument('--converge_step', type=int, metavar='INT', default=10000,
+		help="""Re-estimate abundances every INT classified reads (10000)""")
+	args = vars(parser.parse_args(argv))
 	return args
 
 def print_species_arguments(args):
@@ -142,23 +200,48 @@ def print_species_arguments(args):
 	lines.append("===========Parameters===========")
 	lines.append("Script: run_midas.py species")
 	lines.append("Output directory: %s" % args['outdir'])
-	lines.append("Input reads (1st mate): %s" % args['m1'])
-	lines.append("Input reads (2nd mate): %s" % args['m2'])
+	if args['cohort']:
+		lines.append("Cohort of samples: %s" % args['cohort'])
+	else:
+		lines.append("Input reads (1st mate): %s" % args['m1'])
+		lines.append("Input reads (2nd mate): %s" % args['m2'])
 	lines.append("Remove temporary files: %s" % args['remove_temp'])
+	lines.append("Keep BLAST alignments: %s" % args['keep_m8'])
+	lines.append("Store alignments for --reclassify: %s" % args['keep_alignments'])
+	if args['reclassify']: lines.append("Reclassify reads from stored alignments")
+	lines.append("Read classification method: %s" % args['mode'])
+	if args['mode'] == 'kmer': lines.append("Minimum shared k-mers: %s" % args['min_kmers'])
 	lines.append("Word size for database search: %s" % args['word_size'])
 	if args['mapid']: lines.append("Minimum mapping identity: %s" % args['mapid'])
 	lines.append("Minimum alignment coverage: %s" % args['aln_cov'])
 	lines.append("Number of reads to use from input: %s" % (args['max_reads'] if args['max_reads'] else 'use all'))
+	if args['sample_frac']: lines.append("Uniformly sample fraction of reads: %s" % args['sample_frac'])
+	if args['sample_reads']: lines.append("Uniformly sample number of reads: %s" % args['sample_reads'])
 	if args['read_length']: lines.append("Trim reads to %s-bp and discard reads with length < %s-bp" % (args['read_length'], args['read_length']))
 	lines.append("Number of threads for database search: %s" % args['threads'])
+	if args['dedup']: lines.append("Remove duplicate reads using %s MB" % args['dedup_mem'])
+	if args['readq'] is not None: lines.append("Remove reads with mean quality < %s" % args['readq'])
+	if args['dust'] is not None: lines.append("Remove reads with DUST score > %s" % args['dust'])
+	lines.append("Random seed for subsampling and ambiguously mapped reads: %s" % args['seed'])
+	if args['converge']: lines.append("Stop when top %s species change by < %s every %s classified reads" % (args['converge_topn'], args['converge'], args['converge_step']))
 	args['log'].write('\n'.join(lines)+'\n')
 	sys.stdout.write('\n'.join(lines)+'\n')
 
-def check_species(args):
+def check_species(args, check_db=True):
+	# check reads
+	if not any([args['m1'], args['reclassify'], args['cohort']]):
+		sys.exit("\nError: To align reads, you must specify path to input FASTA/FASTQ with -1")
+	# check cohort
+	if args['cohort']:
+		check_cohort(args)
+	# check that m1 (and m2) exist
+	for arg in ['m1', 'm2']:
+		if args[arg] and not os.path.isfile(args[arg]):
+			sys.exit("\nError: Input file does not exist: '%s'" % args[arg])
 	# check file type
 	if args['m1']: args['file_type'] = utility.auto_detect_file_type(args['m1'])
-	# check database
-	utility.check_database(args)
+	# check database; already checked when run by species server
+	if check_db: utility.check_database(args)
 	# create output directories
 	if not os.path.isdir('%s/species' % args['outdir']):
 		os.makedirs('%s/species' % args['outdir'])
@@ -171,14 +254,124 @@ def check_species(args):
 	# check alignment coverage
 	if args['aln_cov'] < 0 or args['aln_cov'] > 1:
 		sys.exit("\nError: Invalid alignment coverage: %s. Must be between 0 and 1" % args['aln_cov'])
-	# check that m1 (and m2) exist
-	for arg in ['m1', 'm2']:
-		if args[arg] and not os.path.isfile(args[arg]):
-			sys.exit("\nError: Input file does not exist: '%s'" % args[arg])
+	# check convergence options
+	if args['converge'] is not None and (args['converge'] <= 0 or args['converge'] > 1):
+		sys.exit("\nError: Invalid convergence tolerance: %s. Must be between 0 and 1" % args['converge'])
+	if args['converge_topn'] < 1 or args['converge_step'] < 1:
+		sys.exit("\nError: --converge_topn and --converge_step must be positive integers")
+	# check subsampling options
+	if sum([bool(args[_]) for _ in ['max_reads', 'sample_frac', 'sample_reads']]) > 1:
+		sys.exit("\nError: Use only one of -n, --sample_frac, and --sample_reads")
+	if args['sample_frac'] is not None and (args['sample_frac'] <= 0 or args['sample_frac'] > 1):
+		sys.exit("\nError: Invalid sampling fraction: %s. Must be between 0 and 1" % args['sample_frac'])
+	if args['sample_reads'] is not None and args['sample_reads'] < 1:
+		sys.exit("\nError: Invalid number of reads to sample: %s. Must be a positive integer" % args['sample_reads'])
+	# check k-mer options
+	if args['mode'] == 'kmer' and (args['reclassify'] or args['cohort'] or args['keep_m8'] or args['keep_alignments']):
+		sys.exit("\nError: --reclassify, --cohort, --keep_m8, and --keep_alignments require --mode align")
+	# check stored alignments
+	if args['reclassify'] and not os.path.isfile('%s/species/temp/alignments/targets.npy' % args['outdir']):
+		error = "\nError: No stored alignments found in: %s/species/temp/alignments" % args['outdir']
+		error += "\nTo store alignments for --reclassify, run with --keep_alignments"
+		sys.exit(error)
+	if args['min_kmers'] < 1:
+		sys.exit("\nError: Invalid minimum shared k-mers: %s. Must be a positive integer" % args['min_kmers'])
+	# check read filter options
+	if args['dedup'] and args['dedup_mem'] <= 0:
+		sys.exit("\nError: Invalid memory for removing duplicates: %s. Must be positive" % args['dedup_mem'])
+	if args['dust'] is not None and (args['dust'] < 0 or args['dust'] > 100):
+		sys.exit("\nError: Invalid DUST score: %s. Must be between 0 and 100" % args['dust'])
 	# check that extention matches compression
 	if args['m1']: utility.check_compression(args['m1'])
 	if args['m2']: utility.check_compression(args['m2'])
 
+def check_cohort(args):
+	""" Check cohort file and the reads of each sample """
+	if not os.path.isfile(args['cohort']):
+		sys.exit("\nError: Cohort file does not exist: '%s'" % args['cohort'])
+	if args['m1'] or args['m2']:
+		sys.exit("\nError: Specify reads with either -1/-2 or --cohort, not both")
+	if args['reclassify'] or args['converge']:
+		sys.exit("\nError: --reclassify and --converge are not supported with --cohort")
+	fields = next(utility.iopen(args['cohort'])).rstrip('\n').split('\t')
+	for field in ['sample_id', 'm1']:
+		if field not in fields:
+			sys.exit("\nError: Cohort file '%s' has no field labeled '%s'" % (args['cohort'], field))
+	for r in utility.parse_file(args['cohort']):
+		for field in ['m1', 'm2']:
+			if r.get(field) and not os.path.isfile(r[field]):
+				sys.exit("\nError: Input file does not exist: '%s'" % r[field])
+			if r.get(field): utility.check_compression(r[field])
+
+def species_server_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		usage=argparse.SUPPRESS,
+		description="""
+Description:
+Load the species database once and run 'run_midas.py species' jobs submitted over a Unix socket
+Avoids reloading the database for each call when profiling many samples
+Jobs are submitted with species_client.py, which takes the same options as 'run_midas.py species'
+
+Usage: run_midas.py species_server socket [options]
+""",
+		epilog="""Examples:
+1) serve jobs with the default database, running up to 8 threads of database search at a time:
+run_midas.py species_server /tmp/midas.sock -t 8
+
+2) submit a job to the server:
+species_client.py /tmp/midas.sock /path/to/outdir -1 /path/to/reads_1.fq.gz -t 2
+
+""")
+	parser.add_argument('program', help=argparse.SUPPRESS)
+	parser.add_argument('socket', type=str,
+		help="""Path of Unix socket to listen on""")
+	parser.add_argument('-t', type=int, dest='threads', default=1,
+		help="""Total number of threads used by concurrent jobs (1)
+Jobs wait until the threads they request with -t are available""")
+	parser.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
+		help="""Path to reference database
+By default, the MIDAS_DB environmental variable is used""")
+	args = vars(parser.parse_args())
+	return args
+
+def run_species_job(job, server):
+	""" Run 'run_midas.py species' job submitted to species server; returns path to species profile """
+	from midas.run import species
+	args = species_arguments(['species'] + job['argv'])
+	for arg in ['outdir', 'm1', 'm2', 'cohort', 'db']:
+		if args[arg]: args[arg] = os.path.join(job['cwd'], args[arg])
+	if args['db'] and os.path.realpath(args['db']) != os.path.realpath(server.db):
+		sys.exit("\nError: Species server was started with database %s" % server.db)
+	args['db'] = server.db
+	utility.add_executables(args)
+	check_species(args, check_db=False)
+	create_directories('species', args)
+	open_log('species', args)
+	threads = server.budget.acquire(int(args['threads']))
+	try:
+		args['threads'] = threads
+		utility.print_copyright(args['log'])
+		print_species_arguments(args)
+		kmer_index = server.kmer_index() if args['mode'] == 'kmer' else None
+		species.run_pipeline(args, server.index, kmer_index)
+		write_readme('species', args)
+	finally:
+		server.budget.release(threads)
+		args['log'].close()
+	return '%s/species/species_profile.txt' % args['outdir']
+
+def run_species_server(args):
+	""" Load database and serve species jobs until interrupted """
+	from midas.run import species_server
+	utility.check_database(args)
+	if args['threads'] < 1:
+		sys.exit("\nError: Invalid number of threads: %s. Must be a positive integer" % args['threads'])
+	print("Loading species database: %s" % args['db'])
+	server = species_server.SpeciesServer(args['socket'], args['db'], args['threads'], run_species_job)
+	print("Serving species jobs at %s with %s threads" % (args['socket'], args['threads']))
+	server.serve()
+
 def create_directories(program, args):
 	dirs = [args['outdir']]
 	dirs.append('%s/%s' % (args['outdir'], program))
@@ -234,6 +427,15 @@ By default, the MIDAS_DB environmental variable is used""")
 	db.add_argument('--species_cov', type=float, dest='species_cov', metavar='FLOAT', help='Include species with >X coverage (3.0)')
 	db.add_argument('--species_topn', type=int, dest='species_topn', metavar='INT', help='Include top N most abundant species')
 	db.add_argument('--species_id', type=str, dest='species_id', metavar='CHAR', help='Include specified species. Separate ids with a comma')
+	db.add_argument('--index_cache', type=str, metavar='DIR', default=os.environ['MIDAS_INDEX_CACHE'] if 'MIDAS_INDEX_CACHE' in os.environ else None,
+		help="""Directory of bowtie2 databases shared between runs
+Databases are reused by runs that select the same species from the same reference database
+By default, the MIDAS_INDEX_CACHE environmental variable is used; if unset, no cache is used""")
+	db.add_argument('--cache_size', type=float, metavar='GB', default=100,
+		help='Remove least recently used databases when cache exceeds GB (100)')
+	db.add_argument('--prebuilt', default=False, action='store_true',
+		help="""Align reads to bowtie2 database of all species built by build_midas_db.py --bowtie2_index
+Only alignments to selected species are kept; no per-sample database is built""")
 	align = parser.add_argument_group('Read alignment options (if using --align)')
 	align.add_argument('-1', type=str, dest='m1', required=True,
 		help="""FASTA/FASTQ file containing 1st mate if using paired-end reads.
@@ -249,6 +451,17 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		help='# reads to use from input file(s) (use all)')
 	align.add_argument('-t', dest='threads', default=1,
 		help='Number of threads to use')
+	align.add_argument('--dedup', default=False, action='store_true',
+		help='Remove exact duplicate reads (or read pairs) before alignment')
+	align.add_argument('--dedup_mem', type=float, metavar='MB', default=256,
+		help='Memory for detecting duplicates with a Bloom filter (256)')
+	align.add_argument('--dust', type=float, metavar='FLOAT',
+		help='Discard low-complexity reads with DUST score > DUST before alignment\nScores range from 0-100; ex: 20')
+	align.add_argument('--prefilter', default=False, action='store_true',
+		help='Discard reads with mean quality < READQ before alignment instead of after')
+	align.add_argument('--keep_bam', default=False, action='store_true',
+		help="""Write alignments to temp/pangenomes.bam when also using --call_genes
+By default, gene coverage is counted as reads are aligned and no bamfile is written""")
 	map = parser.add_argument_group('Quantify genes options (if using --call_genes)')
 	map.add_argument('--readq', type=int, metavar='INT',
 		default=20, help='Discard reads with mean quality < READQ (20)')
@@ -260,6 +473,9 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		default=0.75, help='Discard reads with alignment coverage < ALN_COV (0.75)')
 	map.add_argument('--trim', type=int, default=0, metavar='INT',
 		help='Trim N base-pairs from read-tails (0)')
+	map.add_argument('--sparse', default=False, action='store_true',
+		help="""Write coverage and copy number of genes with nonzero coverage to binary files:
+output/{SPECIES_ID}.genes.npz, indexed by gene order in pan_genomes/{SPECIES_ID}/gene_ids.txt of the database""")
 	args = vars(parser.parse_args())
 	if args['species_id']: args['species_id'] = args['species_id'].split(',')
 	return args
@@ -285,6 +501,10 @@ def print_gene_arguments(args):
 			lines.append("  include all species with >=%sX genome coverage" % args['species_cov'])
 		if args['species_id']:
 			lines.append("  include specified species id(s): %s" % args['species_id'])
+		if args['prebuilt']:
+			lines.append("  use prebuilt database of all species: %s/bowtie2_indexes" % args['db'])
+		elif args['index_cache']:
+			lines.append("  reuse databases cached in: %s (up to %s GB)" % (args['index_cache'], args['cache_size']))
 	if args['align']:
 		lines.append("Read alignment options:")
 		lines.append("  input reads (1st mate): %s" % args['m1'])
@@ -292,6 +512,10 @@ def print_gene_arguments(args):
 		lines.append("  alignment speed/sensitivity: %s" % args['speed'])
 		lines.append("  number of reads to use from input: %s" % (args['max_reads'] if args['max_reads'] else 'use all'))
 		lines.append("  number of threads for database search: %s" % args['threads'])
+		if args['dedup']: lines.append("  remove duplicate reads using %s MB" % args['dedup_mem'])
+		if args['dust'] is not None: lines.append("  remove reads with DUST score > %s" % args['dust'])
+		if args['prefilter']: lines.append("  remove reads with mean quality < %s before alignment" % args['readq'])
+		if args['cov']: lines.append("  write bamfile of alignments: %s" % args['keep_bam'])
 	if args['cov']:
 		lines.append("Gene coverage options:")
 		lines.append("  minimum alignment percent identity: %s" % args['mapid'])
@@ -299,6 +523,7 @@ def print_gene_arguments(args):
 		lines.append("  minimum read quality score: %s" % args['readq'])
 		lines.append("  minimum mapping quality score: %s" % args['mapq'])
 		lines.append("  trim %s base-pairs from read-tails" % args['trim'])
+		if args['sparse']: lines.append("  write sparse binary output files")
 	args['log'].write('\n'.join(lines)+'\n')
 	sys.stdout.write('\n'.join(lines)+'\n')
 
@@ -340,7 +565,7 @@ run_midas.py snps /path/to/outdir --call_snps --mapid 95 --baseq 35
 	pipe.add_argument('--align', action='store_true', dest='align',
 		default=False, help='Align reads to pangenome database')
 	pipe.add_argument('--call_snps', action='store_true', dest='call',
-		default=False, help='Run samtools mpileup and call SNPs')
+		default=False, help='Count alleles at each genome position and call SNPs')
 	db = parser.add_argument_group('Database options (if using --build_db)')
 	db.add_argument('-d', type=str, dest='db', default=os.environ['MIDAS_DB'] if 'MIDAS_DB' in os.environ else None,
 		help="""Path to reference database
@@ -348,6 +573,15 @@ By default, the MIDAS_DB environmental variable is used""")
 	db.add_argument('--species_cov', type=float, dest='species_cov', metavar='FLOAT', help='Include species with >X coverage (3.0)')
 	db.add_argument('--species_topn', type=int, dest='species_topn', metavar='INT', help='Include top N most abundant species')
 	db.add_argument('--species_id', type=str, dest='species_id', metavar='CHAR', help='Include specified species. Separate ids with a comma')
+	db.add_argument('--index_cache', type=str, metavar='DIR', default=os.environ['MIDAS_INDEX_CACHE'] if 'MIDAS_INDEX_CACHE' in os.environ else None,
+		help="""Directory of bowtie2 databases shared between runs
+Databases are reused by runs that select the same species from the same reference database
+By default, the MIDAS_INDEX_CACHE environmental variable is used; if unset, no cache is used""")
+	db.add_argument('--cache_size', type=float, metavar='GB', default=100,
+		help='Remove least recently used databases when cache exceeds GB (100)')
+	db.add_argument('--prebuilt', default=False, action='store_true',
+		help="""Align reads to bowtie2 database of all species built by build_midas_db.py --bowtie2_index
+Only alignments to selected species are kept; no per-sample database is built""")
 	align = parser.add_argument_group('Read alignment options (if using --align)')
 	align.add_argument('-1', type=str, dest='m1', required=True,
 		help="""FASTA/FASTQ file containing 1st mate if using paired-end reads.
@@ -361,6 +595,10 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		help='Bowtie2 alignment speed/sensitivity (very-sensitive)')
 	align.add_argument('-n', type=int, dest='max_reads', help='# reads to use from input file(s) (use all)')
 	align.add_argument('-t', dest='threads', default=1, help='Number of threads to use')
+	align.add_argument('--dedup', default=False, action='store_true', help='Remove exact duplicate reads (or read pairs) before alignment')
+	align.add_argument('--dedup_mem', type=float, metavar='MB', default=256, help='Memory for detecting duplicates with a Bloom filter (256)')
+	align.add_argument('--dust', type=float, metavar='FLOAT', help='Discard low-complexity reads with DUST score > DUST before alignment\nScores range from 0-100; ex: 20')
+	align.add_argument('--prefilter', default=False, action='store_true', help='Discard reads with mean quality < READQ before alignment instead of after')
 	snps = parser.add_argument_group('SNP calling options (if using --call_snps)')
 	snps.add_argument('--mapid', type=float, metavar='FLOAT',
 		default=94.0, help='Discard reads with alignment identity < MAPID (94.0)')
@@ -378,6 +616,9 @@ Can be gzip'ed (extension: .gz) or bzip2'ed (extension: .bz2)""")
 		help='Enable BAQ (per-base alignment quality)')
 	snps.add_argument('--adjust_mq', default=False, action='store_true',
 		help='Adjust MAPQ')
+	snps.add_argument('--mpileup', default=False, action='store_true',
+		help="""Count alleles by parsing the output of samtools mpileup run once per species (reference mode)
+By default, alleles are counted from the bamfile with pysam using the same options""")
 	args = vars(parser.parse_args())
 	if args['species_id']: args['species_id'] = args['species_id'].split(',')
 	return args
@@ -394,7 +635,7 @@ def print_snp_arguments(args):
 	if args['align']:
 		lines.append("  align reads to bowtie2 genome database")
 	if args['call']:
-		lines.append("  use samtools to generate pileups and call SNPs")
+		lines.append("  count alleles and call SNPs")
 	if args['build_db']:
 		lines.append("Database options:")
 		if args['species_topn']:
@@ -403,6 +644,10 @@ def print_snp_arguments(args):
 			lines.append("  include all species with >=%sX genome coverage" % args['species_cov'])
 		if args['species_id']:
 			lines.append("  include specified species id(s): %s" % args['species_id'])
+		if args['prebuilt']:
+			lines.append("  use prebuilt database of all species: %s/bowtie2_indexes" % args['db'])
+		elif args['index_cache']:
+			lines.append("  reuse databases cached in: %s (up to %s GB)" % (args['index_cache'], args['cache_size']))
 	if args['align']:
 		lines.append("Read alignment options:")
 		lines.append("  input reads (1st mate): %s" % args['m1'])
@@ -410,6 +655,9 @@ def print_snp_arguments(args):
 		lines.append("  alignment speed/sensitivity: %s" % args['speed'])
 		lines.append("  number of reads to use from input: %s" % (args['max_reads'] if args['max_reads'] else 'use all'))
 		lines.append("  number of threads for database search: %s" % args['threads'])
+		if args['dedup']: lines.append("  remove duplicate reads using %s MB" % args['dedup_mem'])
+		if args['dust'] is not None: lines.append("  remove reads with DUST score > %s" % args['dust'])
+		if args['prefilter']: lines.append("  remove reads with mean quality < %s before alignment" % args['readq'])
 	if args['call']:
 		lines.append("SNP calling options:")
 		lines.append("  minimum alignment percent identity: %s" % args['mapid'])
@@ -420,6 +668,8 @@ def print_snp_arguments(args):
 		if args['discard']: lines.append("  discard discordant read-pairs")
 		if args['baq']: lines.append("  enable BAQ (per-base alignment quality)")
 		if args['adjust_mq']: lines.append("  adjust MAPQ")
+		if args['mpileup']: lines.append("  count alleles with samtools mpileup")
+		lines.append("  number of species to count alleles for in parallel: %s" % args['threads'])
 	args['log'].write('\n'.join(lines)+'\n')
 	sys.stdout.write('\n'.join(lines)+'\n')
 
@@ -471,7 +721,7 @@ Alternatively, you can manually specify one or more species using --species_id"
 	# no bamfile but --cov specified
 	if (args['cov']
 		and not args['align']
-		and not os.path.isfile('%s/genes/temp/pangenome.bam' % args['outdir'])):
+		and not os.path.isfile('%s/genes/temp/pangenomes.bam' % args['outdir'])):
 		error = "\nError: You've specified --call_genes, but no alignments were found"
 		error += "\nTry running with --align"
 		sys.exit(error)
@@ -493,6 +743,17 @@ Alternatively, you can manually specify one or more species using --species_id"
 		sys.exit("\nError: MAPID must be between 1 and 100")
 	if args['aln_cov'] < 0 or args['aln_cov'] > 1:
 		sys.exit("\nError: ALN_COV must be between 0 and 1")
+	if args['dust'] is not None and (args['dust'] < 0 or args['dust'] > 100):
+		sys.exit("\nError: Invalid DUST score: %s. Must be between 0 and 100" % args['dust'])
+	if args['cache_size'] <= 0:
+		sys.exit("\nError: CACHE_SIZE must be greater than 0")
+	if args['prebuilt'] and args['index_cache']:
+		sys.exit("\nError: --prebuilt cannot be used with --index_cache")
+	from midas.run import index_cache
+	if args['prebuilt'] and args['build_db'] and not index_cache.has_prebuilt(args['db'], 'pangenomes'):
+		error = "\nError: No prebuilt bowtie2 database found in: %s" % index_cache.prebuilt_dir(args['db'])
+		error += "\nTo build one, run: build_midas_db.py with --bowtie2_index"
+		sys.exit(error)
 
 def check_snps(args):
 	""" Check validity of command line arguments """
@@ -563,6 +824,17 @@ Alternatively, you can manually specify one or more species using --species_id"
 		sys.exit("\nError: MAPQ must be between 0 and 100")
 	if args['baseq'] < 0 or args['baseq'] > 100:
 		sys.exit("\nError: BASEQ must be between 0 and 100")
+	if args['dust'] is not None and (args['dust'] < 0 or args['dust'] > 100):
+		sys.exit("\nError: Invalid DUST score: %s. Must be between 0 and 100" % args['dust'])
+	if args['cache_size'] <= 0:
+		sys.exit("\nError: CACHE_SIZE must be greater than 0")
+	if args['prebuilt'] and args['index_cache']:
+		sys.exit("\nError: --prebuilt cannot be used with --index_cache")
+	from midas.run import index_cache
+	if args['prebuilt'] and args['build_db'] and not index_cache.has_prebuilt(args['db'], 'genomes'):
+		error = "\nError: No prebuilt bowtie2 database found in: %s" % index_cache.prebuilt_dir(args['db'])
+		error += "\nTo build one, run: build_midas_db.py with --bowtie2_index"
+		sys.exit(error)
 
 def write_readme(program, args):
 	outfile = open('%s/%s/README' % (args['outdir'], program), 'w')
@@ -621,6 +893,12 @@ output/{SPECIES_ID}.genes.gz
   coverage: average read-depth of gene_id (# aligned bp / gene length in bp)
   copy_number: estimated copy-number of gene_id (coverage of gene_id / median coverage of 15 universal single copy genes)
 
+output/{SPECIES_ID}.genes.npz (if using --sparse)
+  numpy .npz archive with genes of nonzero coverage only
+  index: position of gene in pan_genomes/{SPECIES_ID}/gene_ids.txt of the reference database
+  coverage, copy_number: as above for each gene in index (float32)
+  pangenome_size, marker_coverage: as in summary.txt
+
 summary.txt
   species_id: species id
   pangenome_size: number of non-redundant genes in reference pan-genome
@@ -679,6 +957,9 @@ Additional information for each species can be found in the reference database:
 if __name__ == '__main__':
 
 	program = get_program()
+	if program == 'species_server':
+		run_species_server(species_server_arguments())
+		quit()
 	args = get_arguments(program)
 	check_arguments(program, args)
 	create_directories(program, args)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+import sys
+from midas.run import species_server
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3 or sys.argv[1] in ['-h', '--help']:
+		print('')
+		print('Usage: species_client.py socket outdir [options]')
+		print('')
+		print('Submit a species profiling job to a server started with: run_midas.py species_server socket')
+		print('Options are the same as for run_midas.py species; use run_midas.py species -h to view them')
+		print('Relative paths are resolved from the current directory')
+		print('')
+		quit()
+	reply = species_server.submit_job(sys.argv[1], sys.argv[2:])
+	if reply['status'] != 'ok':
+		sys.exit("\nError: Species job failed after %s seconds:\n%s" % (reply['seconds'], reply['message']))
+	print("Species profile written to %s (%s seconds)" % (reply['profile'], reply['seconds']))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+# Compare sites/second of parse_pileup.parse_pileup_slice and the linear-time parse_pileup
+# on synthetic pileup base strings with read starts, read ends, deletions and indels
+
+import argparse, random
+from time import time
+from midas.run import parse_pileup
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		usage=argparse.SUPPRESS,
+		description="""Usage: benchmark_pileup.py [options]""")
+	parser.add_argument('--depths', type=str, metavar='CHAR', default='10,100,1000,10000',
+		help="""Read depths of simulated sites. Separate depths with a comma (10,100,1000,10000)""")
+	parser.add_argument('--sites', type=int, metavar='INT', default=200,
+		help="""Number of sites simulated at each depth (200)""")
+	parser.add_argument('--repeats', type=int, metavar='INT', default=3,
+		help="""Number of times to time each parser; the fastest run is reported (3)""")
+	parser.add_argument('--seed', type=int, metavar='INT', default=1,
+		help="""Seed for random number generator (1)""")
+	return vars(parser.parse_args())
+
+def simulate_pileup(ref_allele, depth, rand):
+	""" Return pileup base string of depth reads
+		Indel lengths have a single digit and mapping qualities exclude '$' and '*' so both parsers agree """
+	quals = [chr(_) for _ in range(33, 75) if chr(_) not in '$*']
+	bases = []
+	for i in range(depth):
+		if rand.random() < 0.05: bases.append('^' + rand.choice(quals)) # read start
+		bases.append(rand.choice('.,.,.,.,ACGTacgt*'))
+		if rand.random() < 0.02: # indel
+			length = rand.randint(1, 9)
+			bases.append(rand.choice('+-') + str(length) + ''.join([rand.choice('ACGTacgt') for _ in range(length)]))
+		if rand.random() < 0.05: bases.append('$') # read end
+	return ''.join(bases)
+
+def time_parser(function, sites, repeats):
+	""" Return fastest time to parse all sites and the allele counts """
+	best = None
+	for i in range(repeats):
+		start = time()
+		counts = [function(ref_allele, pileup) for ref_allele, pileup in sites]
+		elapsed = time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, counts
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	rand = random.Random(args['seed'])
+	print('\t'.join(['depth', 'sites', 'slice_sites_per_sec', 'linear_sites_per_sec', 'speedup', 'counts_match']))
+	for depth in [int(_) for _ in args['depths'].split(',')]:
+		sites = []
+		for i in range(args['sites']):
+			ref_allele = rand.choice('ACGT')
+			sites.append((ref_allele, simulate_pileup(ref_allele, depth, rand)))
+		slice_time, slice_counts = time_parser(parse_pileup.parse_pileup_slice, sites, args['repeats'])
+		linear_time, linear_counts = time_parser(parse_pileup.parse_pileup, sites, args['repeats'])
+		print('\t'.join([str(depth), str(len(sites)),
+			'%.1f' % (len(sites)/slice_time), '%.1f' % (len(sites)/linear_time),
+			'%.2f' % (slice_time/linear_time), str(slice_counts == linear_counts)]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+# Compare runtime and outputs of 'run_midas.py genes' or 'run_midas.py snps' between
+# a per-sample bowtie2 database and the prebuilt database of all species (--prebuilt)
+# The reference database must have been built with: build_midas_db.py --bowtie2_index
+
+import os, sys, argparse, subprocess
+from time import time
+from midas import utility
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		usage=argparse.SUPPRESS,
+		description="""Usage: benchmark_prebuilt.py outdir --species_id CHAR [options]""")
+	parser.add_argument('outdir', type=str,
+		help="""Directory to store results of each database""")
+	parser.add_argument('--program', choices=['genes', 'snps'], default='genes',
+		help="""Program to compare (genes)""")
+	parser.add_argument('--species_id', type=str, required=True, metavar='CHAR',
+		help="""Species to include. Separate ids with a comma""")
+	parser.add_argument('-1', type=str, dest='m1', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.fq.gz'),
+		help="""FASTA/FASTQ file of reads (test/test.fq.gz)""")
+	parser.add_argument('-n', type=int, dest='max_reads',
+		help="""Number of reads to use from input file (use all)""")
+	parser.add_argument('-t', type=int, dest='threads', default=1,
+		help="""Number of threads to use for alignment (1)""")
+	parser.add_argument('-d', type=str, dest='db',
+		help="""Path to reference database\nBy default, the MIDAS_DB environmental variable is used""")
+	return vars(parser.parse_args())
+
+def run_database(args, database):
+	""" Run program against per-sample or prebuilt database; return runtime in seconds and output directory """
+	outdir = '%s/%s' % (args['outdir'], database)
+	command = 'run_midas.py %s %s -1 %s -t %s --species_id %s' % (args['program'], outdir, args['m1'], args['threads'], args['species_id'])
+	if database == 'prebuilt': command += ' --prebuilt'
+	if args['max_reads']: command += ' -n %s' % args['max_reads']
+	if args['db']: command += ' -d %s' % args['db']
+	start = time()
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = process.communicate()
+	if process.returncode != 0:
+		sys.exit("\nError encountered executing:\n%s\n\nError message:\n%s" % (command, err.decode()))
+	return time() - start, '%s/%s/output' % (outdir, args['program'])
+
+def read_values(args, indir):
+	""" Read gene coverage (genes) or site depth (snps) from per-species output files """
+	values = {}
+	for species_id in args['species_id'].split(','):
+		if args['program'] == 'genes':
+			for r in utility.parse_file('%s/%s.genes.gz' % (indir, species_id)):
+				values[r['gene_id']] = float(r['coverage'])
+		else:
+			for r in utility.parse_file('%s/%s.snps.gz' % (indir, species_id)):
+				values[(r['ref_id'], r['ref_pos'])] = float(r['depth'])
+	return values
+
+def compare_values(sample, prebuilt):
+	""" Summarize agreement of values between databases """
+	keys = sorted(set(sample) | set(prebuilt))
+	x = [sample.get(_, 0.0) for _ in keys]
+	y = [prebuilt.get(_, 0.0) for _ in keys]
+	mean_x, mean_y = sum(x)/len(x), sum(y)/len(y)
+	cov = sum([(i-mean_x)*(j-mean_y) for i, j in zip(x, y)])
+	var = (sum([(i-mean_x)**2 for i in x]) * sum([(j-mean_y)**2 for j in y]))**0.5
+	covered_x = set([k for k, i in zip(keys, x) if i > 0])
+	covered_y = set([k for k, j in zip(keys, y) if j > 0])
+	return {'pearson_r': cov/var if var > 0 else float('nan'),
+			'total_sample': sum(x),
+			'total_prebuilt': sum(y),
+			'covered_sample': len(covered_x),
+			'covered_prebuilt': len(covered_y),
+			'covered_jaccard': len(covered_x & covered_y)/float(len(covered_x | covered_y)) if covered_x | covered_y else float('nan')}
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	runtimes, values = {}, {}
+	for database in ['sample', 'prebuilt']:
+		runtimes[database], indir = run_database(args, database)
+		values[database] = read_values(args, indir)
+	print("runtime_sample\t%.2f" % runtimes['sample'])
+	print("runtime_prebuilt\t%.2f" % runtimes['prebuilt'])
+	print("speedup\t%.2f" % (runtimes['sample']/runtimes['prebuilt']))
+	for key, value in sorted(compare_values(values['sample'], values['prebuilt']).items()):
+		print("%s\t%s" % (key, value))
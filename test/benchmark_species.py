@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+# Compare runtime and species abundances of 'run_midas.py species' between --mode align and --mode kmer
+
+import os, sys, argparse, subprocess
+from time import time
+from midas.run import species
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		usage=argparse.SUPPRESS,
+		description="""Usage: benchmark_species.py outdir -1 reads.fq.gz [options]""")
+	parser.add_argument('outdir', type=str,
+		help="""Directory to store results of each mode""")
+	parser.add_argument('-1', type=str, dest='m1', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.fq.gz'),
+		help="""FASTA/FASTQ file of reads (test/test.fq.gz)""")
+	parser.add_argument('-n', type=int, dest='max_reads',
+		help="""Number of reads to use from input file (use all)""")
+	parser.add_argument('-t', type=int, dest='threads', default=1,
+		help="""Number of threads to use for database search (1)""")
+	parser.add_argument('-d', type=str, dest='db',
+		help="""Path to reference database\nBy default, the MIDAS_DB environmental variable is used""")
+	parser.add_argument('--topn', type=int, metavar='INT', default=10,
+		help="""Number of most abundant species to compare (10)""")
+	return vars(parser.parse_args())
+
+def run_mode(args, mode):
+	""" Run species profiling with given mode; return runtime in seconds and path to profile """
+	outdir = '%s/%s' % (args['outdir'], mode)
+	command = 'run_midas.py species %s -1 %s -t %s --mode %s' % (outdir, args['m1'], args['threads'], mode)
+	if args['max_reads']: command += ' -n %s' % args['max_reads']
+	if args['db']: command += ' -d %s' % args['db']
+	start = time()
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = process.communicate()
+	if process.returncode != 0:
+		sys.exit("\nError encountered executing:\n%s\n\nError message:\n%s" % (command, err.decode()))
+	return time() - start, '%s/species/species_profile.txt' % outdir
+
+def compare_profiles(align, kmer, topn):
+	""" Summarize agreement of species relative abundances """
+	species_ids = sorted(set(align) | set(kmer))
+	x = [align[_]['relative_abundance'] if _ in align else 0.0 for _ in species_ids]
+	y = [kmer[_]['relative_abundance'] if _ in kmer else 0.0 for _ in species_ids]
+	top_align = set(sorted(align, key=lambda _: -align[_]['relative_abundance'])[:topn])
+	top_kmer = set(sorted(kmer, key=lambda _: -kmer[_]['relative_abundance'])[:topn])
+	mean_x, mean_y = sum(x)/len(x), sum(y)/len(y)
+	cov = sum([(i-mean_x)*(j-mean_y) for i, j in zip(x, y)])
+	var = (sum([(i-mean_x)**2 for i in x]) * sum([(j-mean_y)**2 for j in y]))**0.5
+	return {'pearson_r': cov/var if var > 0 else float('nan'),
+			'l1_distance': sum([abs(i-j) for i, j in zip(x, y)]),
+			'top_species_shared': len(top_align & top_kmer),
+			'reads_align': sum([_['count_reads'] for _ in align.values()]),
+			'reads_kmer': sum([_['count_reads'] for _ in kmer.values()])}
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	runtimes, profiles = {}, {}
+	# kmer mode first, so building the k-mer index is included in its runtime
+	for mode in ['kmer', 'align']:
+		runtimes[mode], inpath = run_mode(args, mode)
+		profiles[mode] = species.read_abundance(inpath)
+	print("runtime_align\t%.2f" % runtimes['align'])
+	print("runtime_kmer\t%.2f" % runtimes['kmer'])
+	print("speedup\t%.2f" % (runtimes['align']/runtimes['kmer']))
+	for key, value in sorted(compare_profiles(profiles['align'], profiles['kmer'], args['topn']).items()):
+		print("%s\t%s" % (key, value))
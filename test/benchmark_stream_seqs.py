@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# MIDAS: Metagenomic Intra-species Diversity Analysis System
+# Copyright (C) 2015 Stephen Nayfach
+# Freely distributed under the GNU General Public License (GPLv3)
+
+# Compare reads/second of stream_seqs.readfq and the block-buffered stream_seqs.parse_batches
+# Both parse the input and format the '>name_len' records written by stream_seqs
+
+import os, argparse
+from time import time
+from midas import utility
+from midas.run import stream_seqs
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		usage=argparse.SUPPRESS,
+		description="""Usage: benchmark_stream_seqs.py [-1 reads.fq.gz] [options]""")
+	parser.add_argument('-1', type=str, dest='m1', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.fq.gz'),
+		help="""FASTA/FASTQ file of reads (test/test.fq.gz)""")
+	parser.add_argument('--repeats', type=int, metavar='INT', default=3,
+		help="""Number of times to time each reader; the fastest run is reported (3)""")
+	return vars(parser.parse_args())
+
+def run_readfq(inpath):
+	""" Read and format records one at a time from decoded text lines """
+	reads = 0
+	size = 0
+	for name, seq, qual in stream_seqs.readfq(utility.iopen(inpath)):
+		size += len('>%s_%s\n%s\n' % (name, len(seq), seq))
+		reads += 1
+	return reads, size
+
+def run_batches(inpath):
+	""" Read and format records in batches parsed from decompressed blocks of bytes """
+	reads = 0
+	size = 0
+	for names, seqs, quals in stream_seqs.prefetch(stream_seqs.parse_batches(inpath)):
+		size += len(b''.join([b'>%s_%d\n%s\n' % (name, len(seq), seq) for name, seq in zip(names, seqs)]))
+		reads += len(seqs)
+	return reads, size
+
+def benchmark(function, inpath, repeats):
+	""" Return number of reads, bytes of output, and fastest runtime in seconds """
+	runtimes = []
+	for i in range(repeats):
+		start = time()
+		reads, size = function(inpath)
+		runtimes.append(time() - start)
+	return reads, size, min(runtimes)
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	results = {}
+	for name, function in [('readfq', run_readfq), ('parse_batches', run_batches)]:
+		results[name] = benchmark(function, args['m1'], args['repeats'])
+		reads, size, runtime = results[name]
+		print("%s\treads=%s\toutput_bytes=%s\tseconds=%.3f\treads_per_second=%.0f" % (name, reads, size, runtime, reads/runtime))
+	if results['readfq'][:2] != results['parse_batches'][:2]:
+		print("warning: readers produced different output")
+	print("speedup\t%.2f" % (results['readfq'][2]/results['parse_batches'][2]))
@@ -111,6 +111,23 @@ class RunSNPs(unittest.TestCase):
 		error = "\n\nFailed to execute the command: %s " % self.command
 		self.assertTrue(run(self.command)==0, msg=error)
 
+class RunGenesCallGenes(unittest.TestCase):
+	""" test run_midas.py genes --call_genes on alignments from an earlier run, with 1 and 4 threads """
+	def setUp(self):
+		import gzip
+		self.retcodes = []
+		self.outputs = []
+		self.retcodes.append(run('run_midas.py genes ./sample -1 ./test.fq.gz --species_id Bacteroides_vulgatus_57955 --build_db --align'))
+		for threads in [1, 4]:
+			self.retcodes.append(run('run_midas.py genes ./sample -1 ./test.fq.gz --call_genes -t %s' % threads))
+			outpath = './sample/genes/output/Bacteroides_vulgatus_57955.genes.gz'
+			self.outputs.append(gzip.open(outpath).read() if os.path.isfile(outpath) else None)
+	def test_help_text(self):
+		error = "\n\nFailed to execute the command: run_midas.py genes --call_genes "
+		self.assertTrue(sum(self.retcodes)==0, msg=error)
+		self.assertTrue(self.outputs[0] is not None, msg=error)
+		self.assertEqual(self.outputs[0], self.outputs[1], msg="\n\nGene coverage differs between 1 and 4 threads")
+
 class MergeSpecies(unittest.TestCase):
 	""" test merge_midas.py species """
 	def setUp(self):
@@ -141,6 +158,31 @@ class MergeSNPs(unittest.TestCase):
 		error = "\n\nFailed to execute the command: merge_midas.py snps "
 		self.assertTrue(sum(self.retcodes)==0, msg=error)
 
+class ParsePileup(unittest.TestCase):
+	""" test linear-time parse_pileup against the original parser """
+	def setUp(self):
+		import random
+		from midas.run import parse_pileup
+		self.parse_pileup = parse_pileup
+		rand = random.Random(1)
+		quals = [chr(_) for _ in range(33, 75) if chr(_) not in '$*'] # characters removed by original parser
+		self.sites = []
+		for i in range(200):
+			bases = ''
+			for j in range(rand.randint(0, 300)):
+				if rand.random() < 0.05: bases += '^' + rand.choice(quals)
+				bases += rand.choice('.,ACGTacgt*')
+				if rand.random() < 0.05:
+					length = rand.randint(1, 9)
+					bases += rand.choice('+-') + str(length) + ''.join([rand.choice('ACGTacgt') for _ in range(length)])
+				if rand.random() < 0.05: bases += '$'
+			self.sites.append((rand.choice('ACGT'), bases))
+	def test_parse_pileup(self):
+		for ref_allele, bases in self.sites:
+			self.assertEqual(self.parse_pileup.parse_pileup(ref_allele, bases), self.parse_pileup.parse_pileup_slice(ref_allele, bases))
+		counts = self.parse_pileup.parse_pileup('A', '^+.,+12ACGTACGTACGT$.-10acgtacgtacT^-g*')
+		self.assertEqual([counts[_] for _ in 'ACGT'], [3, 0, 1, 1])
+
 if __name__ == '__main__':
 	unittest.main()
 	shutil.rmtree('test')
\ No newline at end of file